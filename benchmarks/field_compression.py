@@ -0,0 +1,101 @@
+"""
+Benchmark of the chunking and compression options of the field files (`GeneralConfig.field_compression`,
+`GeneralConfig.field_shuffle` and `GeneralConfig.field_chunk_size`) on the grids of `settings/case0*.yaml` to
+`settings/case11*.yaml`.
+For each grid and option, it reports the write throughput of `save_vary_field` and the size of the written file, which
+contains the field and the cell ids, and how much smaller it is than the uncompressed data.
+
+The field is a smooth, logarithmically distributed permeability field similar to a perlin field, but much cheaper to
+compute for the large grids.
+Pass a directory on the file system you want to benchmark, e.g., a parallel file system, as the first argument;
+otherwise a temporary directory is used.
+Run it from the repository root with
+
+    python -m benchmarks.field_compression [directory]
+"""
+
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from vampireman.data_structures import Compression, GeneralConfig, State
+from vampireman.pflotran.render_stage.pflotran_in_renderer import field_dataset_options, save_vary_field
+
+SETTINGS_DIRECTORY = Path(__file__).parents[1] / "settings"
+CASES = range(12)
+REPETITIONS = 3
+OPTIONS = {
+    "uncompressed": {},
+    "chunked": {"field_chunk_size": 2**16},
+    "gzip 1": {"field_compression": Compression.GZIP, "field_compression_level": 1},
+    "gzip 4": {"field_compression": Compression.GZIP},
+    "gzip 4 shuffle": {"field_compression": Compression.GZIP, "field_shuffle": True},
+    "gzip 9 shuffle": {"field_compression": Compression.GZIP, "field_compression_level": 9, "field_shuffle": True},
+    "lzf": {"field_compression": Compression.LZF},
+    "lzf shuffle": {"field_compression": Compression.LZF, "field_shuffle": True},
+}
+
+
+def smooth_field(number_cells) -> np.ndarray:
+    """
+    Returns a smooth field between 1e-11 and 1e-9 on a logarithmic scale, as large as the grid.
+    """
+
+    rng = np.random.default_rng(0)
+    axes = [np.linspace(0, rng.uniform(2, 6) * np.pi, n) + rng.uniform(0, np.pi) for n in number_cells]
+    x, y, z = np.meshgrid(*axes, indexing="ij", sparse=True)
+    exponent = (np.sin(x) * np.cos(y) + np.sin(y + z)) / 2  # between -1 and 1
+    return 10 ** (-10 + exponent)
+
+
+def best_time(filename: Path, field: np.ndarray, general: GeneralConfig) -> float:
+    """
+    Return the best run time of `save_vary_field` out of `REPETITIONS` runs.
+    """
+
+    dataset_options = field_dataset_options(general, field.size)
+    times = []
+    for _ in range(REPETITIONS):
+        start_time = time.perf_counter()
+        save_vary_field(filename, general.number_cells, field, "permeability", dataset_options=dataset_options)
+        times.append(time.perf_counter() - start_time)
+
+    return min(times)
+
+
+def main(directory: Path):
+    # Cases on the same grid only need to be benchmarked once
+    grids: dict[tuple[int, ...], list[str]] = {}
+    for case in CASES:
+        (settings_file,) = SETTINGS_DIRECTORY.glob(f"case{case}_*.yaml")
+        state = State.from_yaml(str(settings_file))
+        grids.setdefault(tuple(state.general.number_cells.tolist()), []).append(f"case{case}")
+
+    print(f"Writing to {directory}, best of {REPETITIONS} runs")
+    for number_cells, cases in grids.items():
+        field = smooth_field(number_cells)
+        # The 4 byte cell ids are written along with the field
+        data_size = field.nbytes + 4 * field.size
+        print(f"\nGrid {list(number_cells)} ({', '.join(cases)}), {data_size / 2**20:.1f} MiB of data")
+
+        for name, options in OPTIONS.items():
+            general = GeneralConfig(number_cells=np.array(number_cells), **options)
+            filename = directory / f"{name.replace(' ', '_')}.h5"
+            seconds = best_time(filename, field, general)
+            size = filename.stat().st_size
+            print(
+                f"{name:>16}: {seconds:8.3f}s {data_size / 2**20 / seconds:8.1f} MiB/s "
+                f"{size / 2**20:9.2f} MiB ({data_size / size:5.2f}x)"
+            )
+            filename.unlink()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(Path(sys.argv[1]))
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            main(Path(directory))
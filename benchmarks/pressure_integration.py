@@ -0,0 +1,83 @@
+"""
+Benchmark of `vampireman.variation_stage.vary_perlin.calc_pressure_from_gradient_field` against the previous column by
+column integration, on the grid of `settings/case11_large-domain.yaml`.
+
+Run it from the repository root with
+
+    python -m benchmarks.pressure_integration
+"""
+
+import time
+from pathlib import Path
+
+import numpy as np
+
+from vampireman.data_structures import Parameter, State, ValuePerlin, Vary
+from vampireman.variation_stage.vary_perlin import calc_pressure_from_gradient_field
+
+SETTINGS_FILE = Path(__file__).parents[1] / "settings" / "case11_large-domain.yaml"
+REPETITIONS = 3
+
+
+def calc_pressure_column_by_column(gradient_field, state: State, parameter: Parameter):
+    """
+    The previous implementation of `calc_pressure_from_gradient_field`, integrating one column after the other.
+    """
+
+    value = parameter.value
+    assert isinstance(value, ValuePerlin)
+
+    current_min = np.min(gradient_field)
+    current_max = np.max(gradient_field)
+    gradient_field = (gradient_field - current_min) / (current_max - current_min) * (value.max - value.min) + value.min
+
+    reference = 101325
+    resolution = state.general.cell_resolution
+
+    pressure_field = np.zeros(gradient_field.shape)
+    pressure_field[:, 0] = reference
+    for i in range(1, pressure_field.shape[1]):
+        pressure_field[:, i] = pressure_field[:, i - 1] + gradient_field[:, i] * resolution * 1000
+    pressure_field = pressure_field[::-1]
+
+    return pressure_field
+
+
+def best_time(function, gradient_field, state, parameter):
+    """
+    Return the result and the best run time out of `REPETITIONS` runs.
+    Each run gets its own copy of the `gradient_field`, as it may be modified in place.
+    """
+
+    times = []
+    for _ in range(REPETITIONS):
+        field = gradient_field.copy()
+        start_time = time.perf_counter()
+        result = function(field, state, parameter)
+        times.append(time.perf_counter() - start_time)
+
+    return result, min(times)
+
+
+def main():
+    state = State.from_yaml(str(SETTINGS_FILE))
+    parameter = Parameter(
+        name="pressure_gradient",
+        vary=Vary.SPACE,
+        value=ValuePerlin(frequency=[18, 18, 18], min=-0.003, max=-0.0008),
+    )
+    gradient_field = np.random.default_rng(0).random(state.general.number_cells)
+
+    print(f"Grid {state.general.number_cells.tolist()}, best of {REPETITIONS} runs")
+
+    expected, column_by_column = best_time(calc_pressure_column_by_column, gradient_field, state, parameter)
+    print(f"column by column: {column_by_column:8.3f}s")
+
+    result, cumulative_sum = best_time(calc_pressure_from_gradient_field, gradient_field, state, parameter)
+    print(f"cumulative sum:   {cumulative_sum:8.3f}s ({column_by_column / cumulative_sum:.1f}x)")
+
+    assert np.array_equal(result, expected), "The results differ"
+
+
+if __name__ == "__main__":
+    main()
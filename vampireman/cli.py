@@ -19,6 +19,7 @@ def invoke_vampireman():
     parser.add_argument("--sim-tool", type=str, default="pflotran", help="name of the simulation tool implementation")
     parser.add_argument("--non-interactive", action="store_true", default=None, help="don't ask for user confirmation")
     parser.add_argument("--log-level", type=str, default="INFO", help="enable debug logging")
+    parser.add_argument("--jobs", type=positive_int, default=None, help="number of simulations to run at once")
 
     args = parser.parse_args()
 
@@ -30,3 +31,14 @@ def invoke_vampireman():
 
     logging.info("Starting up")
     pipeline.run(args)
+
+
+def positive_int(value: str) -> int:
+    """
+    Parses a command line argument that must be a positive integer.
+    """
+
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return number
@@ -16,7 +16,16 @@ import numpy as np
 # This supresses unwanted output as the library tries to write to its installation directory
 with warnings.catch_warnings(action="ignore"):
     from numpydantic import NDArray, Shape
-from pydantic import BaseModel, ConfigDict, Field, PositiveInt, field_validator, model_validator
+from pydantic import (
+    BaseModel,
+    ConfigDict,
+    Field,
+    NonNegativeInt,
+    PositiveFloat,
+    PositiveInt,
+    field_validator,
+    model_validator,
+)
 from ruamel.yaml import YAML
 
 yaml = YAML(typ="safe")
@@ -85,6 +94,94 @@ class SimTool(enum.StrEnum):
     """
 
 
+class GridType(enum.StrEnum):
+    """
+    Enum behind `GeneralConfig.grid_type`.
+    """
+
+    UNSTRUCTURED_EXPLICIT = "unstructured_explicit"
+    """
+    The grid is passed to the simulation tool cell by cell, i.e., as a mesh file and boundary files listing each cell
+    and connection explicitly.
+    This is the default value.
+    """
+
+    STRUCTURED = "structured"
+    """
+    The simulation tool builds the regular grid itself from `GeneralConfig.number_cells` and
+    `GeneralConfig.cell_resolution` and the boundaries are given as the faces of the domain.
+    No mesh or boundary files are written, which saves a lot of I/O for large domains.
+    The cells are numbered in the same order as in the unstructured grid, so fields and heat pump locations map to the
+    same cells.
+    """
+
+
+class Precision(enum.StrEnum):
+    """
+    Enum behind `GeneralConfig.precision`.
+    The values are the names of the corresponding numpy dtypes.
+    """
+
+    DOUBLE = "float64"
+    """
+    Fields are generated and stored in double precision.
+    This is the default value.
+    """
+
+    SINGLE = "float32"
+    """
+    Fields are generated and stored in single precision, which halves their memory and disk usage.
+    """
+
+
+class Sampling(enum.StrEnum):
+    """
+    Enum behind `GeneralConfig.const_sampling`.
+    """
+
+    GRID = "grid"
+    """
+    The values of each `Vary.CONST` `Parameter` are spaced evenly between its min and max value.
+    This is the default value.
+    """
+
+    SOBOL = "sobol"
+    """
+    The values of all `Vary.CONST` `Parameter`s are drawn jointly from a scrambled Sobol' sequence.
+    Its points are best balanced when `GeneralConfig.number_datapoints` is a power of two.
+    """
+
+    LATIN_HYPERCUBE = "latin_hypercube"
+    """
+    The values of all `Vary.CONST` `Parameter`s are drawn jointly from a Latin hypercube design.
+    """
+
+
+class Compression(enum.StrEnum):
+    """
+    Enum behind `GeneralConfig.field_compression`.
+    """
+
+    NONE = "none"
+    """
+    The datasets are stored uncompressed.
+    This is the default value.
+    """
+
+    GZIP = "gzip"
+    """
+    The datasets are compressed with gzip at `GeneralConfig.field_compression_level`.
+    Every HDF5 installation can read these files.
+    """
+
+    LZF = "lzf"
+    """
+    The datasets are compressed with the LZF filter of h5py, which is a lot faster than gzip, but compresses less.
+    Other tools, e.g., the simulation tool, can only read these files if the LZF filter plugin is found in the
+    `HDF5_PLUGIN_PATH`.
+    """
+
+
 class ValueTimeSpan(BaseModel):
     """
     The timespan that the simulation tool should simulate.
@@ -223,6 +320,52 @@ class ValuePerlin(BaseModel):
         return f"Freq: {self.frequency}, [{self.min} <= {self.max}]"
 
 
+class ValueGaussianField(BaseModel):
+    """
+    Datastructure to represent a Gaussian random field for `Parameter.value`.
+    Unlike a `ValuePerlin` field, its spatial structure is described by geostatistical quantities: the field is normally
+    distributed around `ValueGaussianField.mean` with a Gaussian covariance, i.e., the correlation of two cells decays
+    like `exp(-(distance / correlation_length)**2)`.
+
+    With `Distribution.LOG`, the logarithm of the field is a Gaussian random field, i.e., the field is log-normally
+    distributed, which is the common model for permeability fields.
+    """
+
+    correlation_length: list[float]
+    """
+    The correlation length in x, y and z direction, in the same unit as `GeneralConfig.cell_resolution`.
+    The larger these values are, the larger the structures in the field will be.
+    """
+
+    variance: float = Field(ge=0)
+    """
+    The variance of the field.
+    With `Distribution.LOG`, this is the variance of the base 10 logarithm of the field.
+    """
+
+    mean: float
+    """
+    The mean of the field.
+    With `Distribution.LOG`, this is the geometric mean of the field, so it must be positive.
+    """
+
+    model_config = ConfigDict(extra="forbid")
+
+    @model_validator(mode="after")
+    def ensure_3d_correlation_length(self):
+        """
+        Check if the correlation length is 3d and positive.
+        """
+
+        make_value_3d(self.correlation_length)
+        if any(length <= 0 for length in self.correlation_length):
+            raise ValueError("`correlation_length` values must be positive")
+        return self
+
+    def __str__(self) -> str:
+        return f"Correlation length: {self.correlation_length}, mean: {self.mean}, variance: {self.variance}"
+
+
 class HeatPump(BaseModel):
     """
     Datastructure representing a single heat pump.
@@ -304,6 +447,7 @@ class Parameter(BaseModel):
         | HeatPumps
         | HeatPump
         | ValuePerlin
+        | ValueGaussianField
         | ValueMinMax
         | ValueXYZ
         | Path  # Could use pydantic.FilePath here, but then tests fail as cwd does not match
@@ -431,11 +575,138 @@ class GeneralConfig(BaseModel):
     Cells can only be cubic.
     """
 
+    grid_type: GridType = GridType.UNSTRUCTURED_EXPLICIT
+    """
+    How the grid is described to the simulation tool, see `GridType`.
+    """
+
+    precision: Precision = Precision.DOUBLE
+    """
+    The floating point precision of the generated fields, see `Precision`.
+    This applies to the perlin and constant fields in the `Data.value`s and to the field files passed to the simulation
+    tool.
+    The pressure field calculated from a pressure gradient field is always kept in double precision, as the small
+    pressure differences between cells would otherwise be lost next to the absolute pressure.
+    """
+
+    field_compression: Compression = Compression.NONE
+    """
+    The compression filter of the datasets in the `.h5` field files written by the render stage, see `Compression`.
+    """
+
+    field_compression_level: int = Field(default=4, ge=0, le=9)
+    """
+    The level of `Compression.GZIP`, from 0 (fastest) to 9 (smallest files).
+    """
+
+    field_shuffle: bool = False
+    """
+    Whether to apply the shuffle filter before compressing the field files.
+    It groups the bytes of the values by significance, which usually lets floating point fields compress a lot better.
+    """
+
+    field_chunk_size: None | PositiveInt = None
+    """
+    The number of cells per chunk of the datasets in the field files.
+    Compressed datasets are always chunked, with chunks of 2**16 cells by default, uncompressed datasets are only
+    chunked if this is set.
+    """
+
+    incremental_render: bool = True
+    """
+    Whether the render stage only writes the files that changed since the last run into the same
+    `GeneralConfig.output_directory`.
+    Each rendered data point records a fingerprint of everything its files are rendered from, i.e., the template, its
+    values and fields and the render settings, including the grid, and is skipped when rendered again with the same
+    fingerprint.
+    The mesh and boundary files are only rendered again when the grid changed.
+    So after a small change of the settings, only the affected data points are rendered again, and the timestamps of
+    all other files stay the same.
+    """
+
+    mesh_chunk_size: PositiveInt = 2**16
+    """
+    The number of cells that are rendered and written to the mesh file at once.
+    The mesh is never held in memory as a whole, so this bounds the memory needed to render it, no matter how large
+    `GeneralConfig.number_cells` is.
+    Larger values render slightly faster, but need more memory.
+    """
+
+    perlin_chunk_size: None | PositiveInt = None
+    """
+    The number of cells of a perlin field that are computed at once.
+    When set, perlin fields are computed chunk by chunk into memory-mapped temporary files (in the directory given by
+    the `TMPDIR` environment variable), and scaled to their min/max values in a second pass over the chunks.
+    This bounds the memory needed to compute a field by the chunk size, so fields larger than the available memory can
+    be generated.
+    The resulting fields are the same as without chunking.
+
+    By default, perlin fields are computed in memory as a whole.
+    """
+
+    perlin_cache_directory: None | Path = None
+    """
+    A directory to cache perlin fields in.
+    A perlin field only depends on `GeneralConfig.number_cells`, the random offset and frequencies drawn for it and
+    the `Parameter` it is computed for, so when a data set is generated again with the same `GeneralConfig.random_seed`,
+    e.g., after only changing `GeneralConfig.time_to_simulate`, its fields can be loaded from the cache instead of
+    being computed again.
+    Cached fields are memory-mapped, so they are only read from disk when needed.
+
+    By default, perlin fields are not cached.
+    """
+
+    perlin_cache_size: PositiveInt = 2**34
+    """
+    The maximum size of the `GeneralConfig.perlin_cache_directory` in bytes.
+    When it is exceeded, the least recently used fields are removed from the cache.
+    """
+
+    number_workers: PositiveInt = 1
+    """
+    The number of worker processes used for CPU bound work, e.g., for computing perlin fields or rendering the mesh.
+    The results are the same for any number of workers.
+    By default, everything runs in the main process.
+    """
+
+    mesh_cache_directory: None | Path = None
+    """
+    A directory to cache the mesh and boundary files in.
+    These files only depend on `GeneralConfig.number_cells` and `GeneralConfig.cell_resolution`, so data sets on the
+    same grid can share them.
+    When set, the files are rendered into this directory once and then hardlinked (or copied, if hardlinking is not
+    possible) into the `GeneralConfig.output_directory` of each data set.
+
+    By default, the files are rendered for every data set.
+    """
+
     shuffle_datapoints: bool = True
     """
     Whether or not to shuffle the order the calculated `Data` from each parameter appears in the `DataPoint`s.
     """
 
+    const_sampling: Sampling = Sampling.GRID
+    """
+    How the values of the `Vary.CONST` `Parameter`s with min and max values are chosen, see `Sampling`.
+
+    By default, the values of each `Parameter` are spaced evenly and only decorrelated from the other `Parameter`s by
+    `GeneralConfig.shuffle_datapoints`, which covers the space of several `Parameter`s poorly.
+    The quasi-random designs cover it much more evenly, so fewer `DataPoint`s are needed for the same coverage.
+    They are drawn with the `State` RNG, so they are reproducible with `GeneralConfig.random_seed`, and the rows of a
+    design stay together when shuffling.
+    """
+
+    streaming: bool = False
+    """
+    Whether or not to run the variation, render, simulation and visualization stages for one `DataPoint` after the
+    other, instead of running each stage for all `DataPoint`s before the next one, see `vampireman.pipeline`.
+    The fields of a `DataPoint` are only computed when it is its turn and are released again once it is rendered, so
+    only the fields of a single `DataPoint` are held in memory, regardless of `GeneralConfig.number_datapoints`.
+    The resulting `DataPoint`s are the same.
+
+    This is off by default, as the `DataPoint`s are not kept in `State.datapoints`.
+    """
+
     interactive: bool = True
     """
     Whether or not to run interactively.
@@ -472,6 +743,20 @@ class GeneralConfig(BaseModel):
     random seed, making it nondeterministic.
     """
 
+    datapoint_random_streams: bool = False
+    """
+    Whether or not to give each `DataPoint` its own independent stream of random numbers, see `State.get_rng`.
+
+    By default, all random values are drawn one after the other from the same random number generator, so the values of
+    a `DataPoint` depend on all values drawn before it.
+    With independent streams, the values of a `DataPoint` only depend on `GeneralConfig.random_seed` and its index, so
+    the `DataPoint`s can be generated in any order or process, and a single `DataPoint` can be generated again on its
+    own.
+    Only shuffling the `DataPoint`s, see `GeneralConfig.shuffle_datapoints`, still uses the shared generator.
+
+    This yields different values than the default.
+    """
+
     number_datapoints: PositiveInt = 1
     """
     The number of datapoints to be generated.
@@ -510,6 +795,34 @@ class GeneralConfig(BaseModel):
     Therefore, the value of `1` is the default.
     """
 
+    simulation_jobs: None | PositiveInt = None
+    """
+    The number of simulations that run at once, each in its own process (or its own `mpirun`).
+    By default, as many simulations run at once as fit on the cores available to VampireMan, i.e., the number of cores
+    divided by `GeneralConfig.mpirun_procs`.
+    If more than one simulation runs at once and `mpirun` is the one of Open MPI, it is run with `--bind-to none`, as
+    Open MPI would otherwise bind the ranks of all simulations to the same cores.
+    Other MPI implementations, e.g., MPICH, don't bind ranks by default, so no option is added for them.
+    The output of each simulation is written to the "simulation.log" file of its data point.
+    Can also be set with the `--jobs` command line option.
+    """
+
+    simulation_timeout: None | PositiveFloat = None
+    """
+    The wall-clock time in seconds one run of a simulation may take, before it is terminated and counted as failed.
+    By default, simulations may take as long as they need.
+    """
+
+    simulation_retries: NonNegativeInt = 1
+    """
+    How often a simulation is started again after it failed transiently, i.e., it timed out or was killed with SIGKILL,
+    e.g., by the out-of-memory killer.
+    Simulations that fail otherwise, e.g., due to invalid input files or aborted by a failed assertion, are not retried,
+    as they would fail again.
+    Data points whose simulation failed in the end don't stop the others, but are listed in the
+    "failed_simulations.json" file in the `GeneralConfig.output_directory`.
+    """
+
     mute_simulation_output: bool = False
     """
     Some simulation tools produce output that can be muted.
@@ -622,6 +935,12 @@ class State(BaseModel):
     When initialized with `None`, it will be nondeterministic.
     """
 
+    _seed_sequence: np.random.SeedSequence = np.random.SeedSequence(0)
+    """
+    The seed sequence `_rng` is initialized with.
+    The independent streams of the `DataPoint`s are spawned from it, see `State.get_rng`.
+    """
+
     # This makes pydantic fail if there is extra data in the YAML settings file that cannot be parsed
     model_config = ConfigDict(extra="forbid")
 
@@ -643,7 +962,8 @@ class State(BaseModel):
         This "validator" instantiates the global RNG.
         """
 
-        self._rng = np.random.default_rng(seed=self.general.random_seed)
+        self._seed_sequence = np.random.SeedSequence(self.general.random_seed)
+        self._rng = np.random.default_rng(seed=self._seed_sequence)
         return self
 
     @model_validator(mode="after")
@@ -708,16 +1028,32 @@ class State(BaseModel):
         self.heatpump_parameters = other_state.heatpump_parameters
         self.datapoints = other_state.datapoints
         self._rng = other_state._rng
+        self._seed_sequence = other_state._seed_sequence
 
-    def get_rng(self) -> np.random.Generator:
+    def get_rng(self, datapoint_index: None | int = None) -> np.random.Generator:
         """
         Returns the execution-wide same instance of the random number generator instantiated with
         `GeneralConfig.random_seed`.
         If using randomness of any kind, the RNG returned by this function should be used to make results as
         reproducible as possible.
+
+        If `GeneralConfig.datapoint_random_streams` is enabled and a `datapoint_index` is given, a new generator for the
+        independent stream of that `DataPoint` is returned instead.
+        It is the same as spawning `GeneralConfig.number_datapoints` children from the seed sequence and taking the one
+        at `datapoint_index`, without the need to spawn the others.
+        As every call starts the stream from its beginning, it should be called once per `DataPoint` and the generator
+        passed on to everything that is varied for it.
         """
 
-        return self._rng
+        if datapoint_index is None or not self.general.datapoint_random_streams:
+            return self._rng
+
+        seed_sequence = np.random.SeedSequence(
+            self._seed_sequence.entropy,
+            spawn_key=(*self._seed_sequence.spawn_key, datapoint_index),
+            pool_size=self._seed_sequence.pool_size,
+        )
+        return np.random.default_rng(seed_sequence)
 
     @staticmethod
     def from_yaml(settings_file_path: str) -> "State":
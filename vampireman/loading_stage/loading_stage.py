@@ -32,6 +32,8 @@ def loading_stage(arguments: argparse.Namespace) -> State:
     # Also consider arguments from command line
     if arguments.non_interactive:
         run_state.general.interactive = False
+    if getattr(arguments, "jobs", None) is not None:
+        run_state.general.simulation_jobs = arguments.jobs
 
     if run_state.general.interactive:
         logging.info("Running interactively")
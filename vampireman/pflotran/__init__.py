@@ -1,3 +1,6 @@
+from .render_stage import render_datapoints as render_datapoints
 from .render_stage import render_stage as render_stage
+from .simulation_stage import simulate_datapoints as simulate_datapoints
 from .simulation_stage import simulation_stage as simulation_stage
 from .visualization_stage import visualization_stage as visualization_stage
+from .visualization_stage import visualize_datapoints as visualize_datapoints
@@ -1 +1,2 @@
+from .pflotran_in_renderer import render_datapoints as render_datapoints
 from .pflotran_in_renderer import render_stage as render_stage
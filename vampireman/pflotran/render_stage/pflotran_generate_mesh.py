@@ -1,8 +1,18 @@
+import functools
+import hashlib
+import json
 import logging
+import os
+import shutil
+import tempfile
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
 from pathlib import Path
 from typing import cast
 
 import numpy as np
+from numpy.typing import NDArray
 
 from ...data_structures import State
 
@@ -11,28 +21,132 @@ def write_mesh_and_border_files(state: State, output_dir: Path) -> None:
     """
     Generate and write ASCII mesh and boundary files for PFLOTRAN to the `output_dir`.
     Called once per data set as the files don't change across data points.
+
+    When `vampireman.data_structures.GeneralConfig.mesh_cache_directory` is set, the files are taken from the cache
+    instead, see `link_mesh_and_border_files_from_cache`.
+    """
+
+    if state.general.mesh_cache_directory is not None:
+        link_mesh_and_border_files_from_cache(state, state.general.mesh_cache_directory, output_dir)
+        return
+
+    render_mesh_and_border_files(state, output_dir)
+
+
+def render_mesh_and_border_files(state: State, output_dir: Path) -> None:
+    """
+    Render the mesh and the boundary files into the `output_dir`.
+
+    The mesh is streamed to disk chunk by chunk, so the memory needed does not grow with
+    `vampireman.data_structures.GeneralConfig.number_cells` but only with
+    `vampireman.data_structures.GeneralConfig.mesh_chunk_size`.
+
+    With more than one `vampireman.data_structures.GeneralConfig.number_workers`, the chunks of the mesh are formatted
+    in a process pool while the main process writes them to disk in order, and the four boundary files are written
+    by the same pool concurrently.
+    The files are the same either way.
     """
 
-    write_lines_to_file("mesh.uge", render_mesh(state), output_dir)
+    number_cells = cast(tuple[int, int, int], tuple(int(n) for n in cast(np.ndarray, state.general.number_cells)))
+    resolution = state.general.cell_resolution
 
-    north, east, south, west = render_borders(state)
-    write_lines_to_file("north.ex", north, output_dir)
-    write_lines_to_file("east.ex", east, output_dir)
-    write_lines_to_file("south.ex", south, output_dir)
-    write_lines_to_file("west.ex", west, output_dir)
+    if state.general.number_workers == 1:
+        write_lines_to_file("mesh.uge", render_mesh(state), output_dir)
+        for border in BORDERS:
+            write_border_file(number_cells, resolution, border, output_dir)
+    else:
+        with ProcessPoolExecutor(max_workers=state.general.number_workers) as executor:
+            borders = [
+                executor.submit(write_border_file, number_cells, resolution, border, output_dir) for border in BORDERS
+            ]
+            write_lines_to_file("mesh.uge", render_mesh(state, executor), output_dir)
+            for border in borders:
+                border.result()
 
     logging.debug("Rendered {north,east,south,west}.ex")
 
 
-def write_lines_to_file(file_name: str, output_strings: list[str], output_dir: Path):
+MESH_FILES = ["mesh.uge", "north.ex", "east.ex", "south.ex", "west.ex"]
+"""
+The files written by `render_mesh_and_border_files`.
+"""
+
+
+def mesh_cache_key(state: State) -> str:
+    """
+    Returns the hash the mesh and boundary files are cached under.
+    The files only depend on `vampireman.data_structures.GeneralConfig.number_cells` and
+    `vampireman.data_structures.GeneralConfig.cell_resolution`.
+    """
+
+    number_cells = [int(n) for n in cast(np.ndarray, state.general.number_cells)]
+    key = json.dumps({"number_cells": number_cells, "cell_resolution": state.general.cell_resolution})
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def link_mesh_and_border_files_from_cache(state: State, cache_dir: Path, output_dir: Path) -> None:
+    """
+    Hardlink the mesh and boundary files from the `cache_dir` into the `output_dir`.
+    If the files are not cached yet, they are rendered into the cache first.
+    When hardlinking is not possible, e.g., because the cache is on another file system, the files are copied.
+
+    As the files are hardlinked, they must not be modified in the `output_dir`.
+    """
+
+    cached_dir = cache_dir / mesh_cache_key(state)
+
+    if cached_dir.is_dir():
+        logging.info("Using cached mesh and boundary files from %s", cached_dir)
+    else:
+        logging.info("Mesh and boundary files are not cached yet, rendering them into %s", cached_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # Render into a temporary directory first, so an aborted run or a concurrent run never leaves half written
+        # files in the cache
+        render_dir = Path(tempfile.mkdtemp(dir=cache_dir, prefix=f".{cached_dir.name}-"))
+        try:
+            render_mesh_and_border_files(state, render_dir)
+        except BaseException:
+            shutil.rmtree(render_dir)
+            raise
+        try:
+            os.rename(render_dir, cached_dir)
+        except OSError:
+            # Another run cached the same files in the meantime
+            shutil.rmtree(render_dir)
+
+    for file_name in MESH_FILES:
+        target = output_dir / file_name
+        if target.exists():
+            target.unlink()
+        try:
+            os.link(cached_dir / file_name, target)
+        except OSError:
+            shutil.copyfile(cached_dir / file_name, target)
+
+
+def write_lines_to_file(file_name: str, output_strings: Iterable[str], output_dir: Path):
     """
     Writes the given lines of `str` to a file.
+    If `output_strings` is a generator, each item is written as soon as it is generated.
+
+    The lines are written to a temporary file first, which then replaces the file.
+    So an existing file is never written through, as it may be hardlinked to the mesh cache, see
+    `link_mesh_and_border_files_from_cache`.
     """
-    with open(f"{output_dir}/{file_name}", "w", encoding="utf8") as file:
-        file.writelines(output_strings)
+
+    path = output_dir / file_name
+    temporary = path.with_name(f".{file_name}.{os.getpid()}.tmp")
+    try:
+        with open(temporary, "w", encoding="utf8") as file:
+            file.writelines(output_strings)
+        os.replace(temporary, path)
+    except BaseException:
+        temporary.unlink(missing_ok=True)
+        raise
 
 
-def render_mesh(state: State) -> list[str]:
+def render_mesh(state: State, executor: Executor | None = None) -> Iterator[str]:
     """
     Generates the contents of a PFLOTRAN mesh.uge file.
 
@@ -45,64 +159,258 @@ def render_mesh(state: State) -> list[str]:
     CONNECTIONS <number of connections>
     <cell id a> <cell id b> <face center coordinate x> <face y> <face z> <area of the face>
     ```
+
+    Cells are numbered with x running fastest, then y, then z.
+    The lines are not formatted one by one, instead `render_cells` and `render_connections` format whole blocks of
+    x-rows with NumPy.
+    Each block is yielded as one string as soon as it is formatted, see `mesh_chunks` for the block size.
+    If an `executor` is given, the blocks are formatted by it, see `map_chunks`.
     """
 
-    xGrid, yGrid, zGrid = cast(np.ndarray, state.general.number_cells)
+    xGrid, yGrid, zGrid = (int(n) for n in cast(np.ndarray, state.general.number_cells))
     resolution = state.general.cell_resolution
+    chunks = mesh_chunks(state)
+    ahead = 2 * state.general.number_workers
 
-    volume = resolution**3
-    face_area = resolution**2
+    yield "CELLS " + str(xGrid * yGrid * zGrid)
+    yield from map_chunks(executor, render_cells, (xGrid, yGrid, zGrid), resolution, chunks, ahead)
+
+    yield "\n"
+
+    yield "CONNECTIONS " + str((xGrid - 1) * yGrid * zGrid + xGrid * (yGrid - 1) * zGrid + xGrid * yGrid * (zGrid - 1))
+    yield from map_chunks(executor, render_connections, (xGrid, yGrid, zGrid), resolution, chunks, ahead)
+
+
+def mesh_chunks(state: State) -> list[tuple[int, int]]:
+    """
+    Splits the x-rows of the mesh into chunks of at most `vampireman.data_structures.GeneralConfig.mesh_chunk_size`
+    cells and returns the first and the last (exclusive) row of each chunk.
+    Each chunk contains at least one row, as rows are never split.
+    When the chunk size is a multiple of the cells in a z-layer, the chunks are whole z-slabs of the domain.
+    """
+
+    x_grid, y_grid, z_grid = (int(n) for n in cast(np.ndarray, state.general.number_cells))
+    number_rows = y_grid * z_grid
+    rows_per_chunk = max(1, state.general.mesh_chunk_size // x_grid)
+
+    return [(first, min(first + rows_per_chunk, number_rows)) for first in range(0, number_rows, rows_per_chunk)]
+
+
+def map_chunks(
+    executor: Executor | None,
+    render_chunk: Callable[[tuple[int, int, int], float, int, int], str],
+    number_cells: tuple[int, int, int],
+    resolution: float,
+    chunks: list[tuple[int, int]],
+    ahead: int = 1,
+) -> Iterator[str]:
+    """
+    Calls `render_chunk` for each of the `chunks` and yields the results in order.
+    Without an `executor`, the chunks are rendered one after another in this process.
+    With an `executor`, up to `ahead` chunks are rendered ahead, so the workers are kept busy while the results are
+    written, without holding more than those chunks in memory.
+    """
+
+    if executor is None:
+        for chunk in chunks:
+            yield render_chunk(number_cells, resolution, *chunk)
+        return
+
+    pending: deque[Future[str]] = deque()
+    for chunk in chunks:
+        pending.append(executor.submit(render_chunk, number_cells, resolution, *chunk))
+        if len(pending) >= ahead:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+NEWLINE = np.frombuffer(b"\n", dtype=np.uint8)
+SPACE = np.frombuffer(b" ", dtype=np.uint8)
+
+
+def ascii_table(strings: list[str], width: int | None = None) -> NDArray[np.uint8]:
+    """
+    Encodes `strings` as an ASCII `uint8` matrix with one row per string.
+    Shorter strings are padded with null bytes on the right, which `join_lines` drops again.
+    """
+
+    table = np.array(strings, dtype="S")
+    width = table.itemsize if width is None else width
+    return table.astype(f"S{width}").view(np.uint8).reshape(len(strings), width)
+
+
+# "000" to "999", each padded to four bytes so a row can be copied as a single uint32
+THOUSANDS = ascii_table([f"{number:03d}" for number in range(1000)], 4).view(np.uint32)[:, 0]
+
+
+def integer_digits(first: int, count: int) -> NDArray[np.uint8]:
+    """
+    Returns the decimal digits of the consecutive integers `first`, ..., `first + count - 1` as an ASCII matrix.
+    Produces the same characters as `str()` once the null padding is dropped.
+    """
+
+    numbers = np.arange(first, first + count, dtype=np.int64)
+    thousands, remainder = np.divmod(numbers, 1000)
 
-    output_string_cells = ["CELLS " + str(xGrid * yGrid * zGrid)]
-    output_string_connections = [
-        "CONNECTIONS " + str((xGrid - 1) * yGrid * zGrid + xGrid * (yGrid - 1) * zGrid + xGrid * yGrid * (zGrid - 1))
+    # The leading digits only take count / 1000 distinct values, so they are formatted by Python and looked up
+    first_thousand = first // 1000
+    last_thousand = (first + count - 1) // 1000
+    leading_width = -(-len(str(last_thousand)) // 8) * 8 if last_thousand else 0
+
+    digits = np.empty((count, leading_width + 4), dtype=np.uint8)
+    if leading_width:
+        leading = ascii_table(
+            [str(number) if number else "" for number in range(first_thousand, last_thousand + 1)], leading_width
+        )
+        digits[:, :leading_width].view(np.uint64)[:] = leading.view(np.uint64)[thousands - first_thousand]
+    digits[:, leading_width:].view(np.uint32)[:, 0] = THOUSANDS[remainder]
+
+    if first_thousand == 0:
+        # Numbers below 1000 have no leading digits, so their zero padding has to go
+        below_thousand = numbers[: 1000 - first, None]
+        digits[: 1000 - first, leading_width : leading_width + 3][below_thousand < [100, 10, 1]] = 0
+
+    return digits
+
+
+@functools.cache
+def axis_table(number: int, resolution: float, offset: float, suffix: str = "") -> NDArray[np.uint8]:
+    """
+    Returns `" {(index + offset) * resolution}{suffix}"` for each index along an axis as an ASCII matrix.
+    Cached, as every chunk of the mesh needs the same few tables.
+    """
+
+    return ascii_table([f" {(index + offset) * resolution}{suffix}" for index in range(number)])
+
+
+def fill_columns(lines: NDArray[np.uint8], parts: list[NDArray[np.uint8]]):
+    """
+    Writes the `parts` next to each other into the last axis of `lines`, broadcasting them over the other axes.
+    """
+
+    column = 0
+    for part in parts:
+        width = part.shape[-1]
+        lines[..., column : column + width] = part
+        column += width
+
+
+def join_lines(lines: NDArray[np.uint8]) -> str:
+    """
+    Joins an ASCII matrix into a single string, dropping the null padding.
+    """
+
+    return lines[lines != 0].tobytes().decode("ascii")
+
+
+def render_cells(number_cells: tuple[int, int, int], resolution: float, first_row: int, last_row: int) -> str:
+    """
+    Formats the `CELLS` lines of the x-rows `first_row` up to `last_row` (exclusive), i.e., of the cells with ids
+    `first_row * x + 1` up to `last_row * x`.
+    Each line is prefixed with a newline, like the lines `render_mesh` used to append one by one.
+    """
+
+    x_grid, y_grid, z_grid = number_cells
+    rows = np.arange(first_row, last_row)
+
+    x_part = axis_table(x_grid, resolution, 0.5)
+    yz_part = np.concatenate(
+        [
+            axis_table(y_grid, resolution, 0.5)[rows % y_grid],
+            axis_table(z_grid, resolution, 0.5, f" {resolution**3}")[rows // y_grid],
+        ],
+        axis=1,
+    )
+    cell_ids = integer_digits(first_row * x_grid + 1, len(rows) * x_grid).reshape(len(rows), x_grid, -1)
+
+    lines = np.zeros((len(rows), x_grid, 1 + cell_ids.shape[-1] + x_part.shape[1] + yz_part.shape[1]), dtype=np.uint8)
+    fill_columns(lines, [NEWLINE, cell_ids, x_part, yz_part[:, None]])
+
+    return join_lines(lines)
+
+
+def render_connections(number_cells: tuple[int, int, int], resolution: float, first_row: int, last_row: int) -> str:
+    """
+    Formats the `CONNECTIONS` lines of the cells in the x-rows `first_row` up to `last_row` (exclusive).
+    Each cell connects to its neighbor in x, y and z direction, in that order, unless it lies on the respective
+    upper border of the domain.
+    """
+
+    x_grid, y_grid, z_grid = number_cells
+    rows = np.arange(first_row, last_row)
+    first_id = first_row * x_grid + 1
+    count = len(rows) * x_grid
+
+    area = f" {resolution**2}"
+    y_centers = axis_table(y_grid, resolution, 0.5)[rows % y_grid]
+    y_faces = axis_table(y_grid, resolution, 1)[rows % y_grid]
+    z_centers = axis_table(z_grid, resolution, 0.5, area)[rows // y_grid]
+    z_faces = axis_table(z_grid, resolution, 1, area)[rows // y_grid]
+
+    # (offset to the neighboring cell id, x part, y and z part) of the connections in x, y and z direction
+    directions = [
+        (1, axis_table(x_grid, resolution, 1), np.concatenate([y_centers, z_centers], axis=1)),
+        (x_grid, axis_table(x_grid, resolution, 0.5), np.concatenate([y_faces, z_centers], axis=1)),
+        (x_grid * y_grid, axis_table(x_grid, resolution, 0.5), np.concatenate([y_centers, z_faces], axis=1)),
     ]
 
-    cellid_1 = 1
+    cell_ids = integer_digits(first_id, count).reshape(len(rows), x_grid, -1)
+    neighbor_ids = [
+        integer_digits(first_id + offset, count).reshape(len(rows), x_grid, -1) for offset, _, _ in directions
+    ]
+    widths = [
+        ids.shape[-1] + x_part.shape[1] + yz_part.shape[1]
+        for ids, (_, x_part, yz_part) in zip(neighbor_ids, directions, strict=True)
+    ]
 
-    for k in range(zGrid):
-        zloc = (k + 0.5) * resolution
+    lines = np.zeros((len(rows), x_grid, 3, 2 + cell_ids.shape[-1] + max(widths)), dtype=np.uint8)
+    for direction, (ids, (_, x_part, yz_part)) in enumerate(zip(neighbor_ids, directions, strict=True)):
+        fill_columns(lines[:, :, direction], [NEWLINE, cell_ids, SPACE, ids, x_part, yz_part[:, None]])
 
-        for j in range(yGrid):
-            yloc = (j + 0.5) * resolution
+    # Cells on the upper borders have no neighbor in that direction
+    lines[:, -1, 0] = 0
+    lines[rows % y_grid == y_grid - 1, :, 1] = 0
+    lines[rows // y_grid == z_grid - 1, :, 2] = 0
 
-            for i in range(xGrid):
-                xloc = (i + 0.5) * resolution
+    return join_lines(lines)
 
-                output_string_cells.append(f"\n{cellid_1} {xloc} {yloc} {zloc} {volume}")
-                cellid_1 += 1
 
-                grid_cellid_1 = i + 1 + j * xGrid + k * xGrid * yGrid
-                if i < xGrid - 1:
-                    xloc_local = (i + 1) * resolution
-                    cellid_2 = grid_cellid_1 + 1
-                    output_string_connections.append(
-                        f"\n{grid_cellid_1} {cellid_2} {xloc_local} {yloc} {zloc} {face_area}"
-                    )
-                if j < yGrid - 1:
-                    yloc_local = (j + 1) * resolution
-                    cellid_2 = grid_cellid_1 + xGrid
-                    output_string_connections.append(
-                        f"\n{grid_cellid_1} {cellid_2} {xloc} {yloc_local} {zloc} {face_area}"
-                    )
-                if k < zGrid - 1:
-                    zloc_local = (k + 1) * resolution
-                    cellid_2 = grid_cellid_1 + xGrid * yGrid
-                    output_string_connections.append(
-                        f"\n{grid_cellid_1} {cellid_2} {xloc} {yloc} {zloc_local} {face_area}"
-                    )
+BORDERS = ["north", "east", "south", "west"]
+"""
+The sides of the domain that get a boundary file.
+"""
 
-    return output_string_cells + ["\n"] + output_string_connections
+
+def write_border_file(number_cells: tuple[int, int, int], resolution: float, border: str, output_dir: Path):
+    """
+    Renders the boundary file of the given `border` and writes it to `<border>.ex` in the `output_dir`.
+    """
+
+    write_lines_to_file(f"{border}.ex", render_border(number_cells, resolution, border), output_dir)
 
 
 def render_borders(state: State):
     """
     Render the PFLOTRAN boundary files
 
-    - east.ex
-    - west.ex
     - north.ex
+    - east.ex
     - south.ex
+    - west.ex
+
+    and return their lines in that order, see `render_border`.
+    """
+
+    number_cells = cast(tuple[int, int, int], tuple(int(n) for n in cast(np.ndarray, state.general.number_cells)))
+    resolution = state.general.cell_resolution
+
+    return tuple(render_border(number_cells, resolution, border) for border in BORDERS)
+
+
+def render_border(number_cells: tuple[int, int, int], resolution: float, border: str) -> list[str]:
+    """
+    Render the PFLOTRAN boundary file of one of the `BORDERS`.
 
     The file format is
 
@@ -111,37 +419,38 @@ def render_borders(state: State):
     <cell id> <face center coordinate x> <face y> <face z> <area of the face>
     ```
     """
-    x_grid, y_grid, z_grid = cast(np.ndarray, state.general.number_cells)
-    resolution = state.general.cell_resolution
+
+    x_grid, y_grid, z_grid = number_cells
 
     face_area = resolution**2
 
-    output_string_east = ["CONNECTIONS " + str(y_grid * z_grid)]
-    output_string_west = ["CONNECTIONS " + str(y_grid * z_grid)]
+    match border:
+        case "north" | "south":
+            output_string = ["CONNECTIONS " + str(x_grid * z_grid)]
+            yloc = y_grid * resolution if border == "north" else 0
+            first_row = x_grid * (y_grid - 1) if border == "north" else 0
+
+            for k in range(z_grid):
+                zloc = (k + 0.5) * resolution
 
-    output_string_north = ["CONNECTIONS " + str(x_grid * z_grid)]
-    output_string_south = ["CONNECTIONS " + str(x_grid * z_grid)]
+                for i in range(x_grid):
+                    xloc = (i + 0.5) * resolution
+                    cellid = first_row + i + 1 + k * x_grid * y_grid
+                    output_string.append(f"\n{cellid} {xloc} {yloc} {zloc} {face_area}")
 
-    yloc_south = 0
-    xloc_west = 0
-    yloc_north = y_grid * resolution
-    xloc_east = x_grid * resolution
+        case "east" | "west":
+            output_string = ["CONNECTIONS " + str(y_grid * z_grid)]
+            xloc = x_grid * resolution if border == "east" else 0
 
-    for k in range(z_grid):
-        zloc = (k + 0.5) * resolution
+            for k in range(z_grid):
+                zloc = (k + 0.5) * resolution
 
-        for i in range(x_grid):
-            xloc = (i + 0.5) * resolution
-            cellid_north = (x_grid * (y_grid - 1)) + i + 1 + k * x_grid * y_grid
-            cellid_south = i + 1 + k * x_grid * y_grid
-            output_string_north.append(f"\n{cellid_north} {xloc} {yloc_north} {zloc} {face_area}")
-            output_string_south.append(f"\n{cellid_south} {xloc} {yloc_south} {zloc} {face_area}")
+                for j in range(y_grid):
+                    yloc = (j + 0.5) * resolution
+                    cellid = (j + 1) * x_grid if border == "east" else j * x_grid + 1
+                    output_string.append(f"\n{cellid + k * x_grid * y_grid} {xloc} {yloc} {zloc} {face_area}")
 
-        for j in range(y_grid):
-            yloc = (j + 0.5) * resolution
-            cellid_east = (j + 1) * x_grid + k * x_grid * y_grid
-            cellid_west = j * x_grid + 1 + k * x_grid * y_grid
-            output_string_east.append(f"\n{cellid_east} {xloc_east} {yloc} {zloc} {face_area}")
-            output_string_west.append(f"\n{cellid_west} {xloc_west} {yloc} {zloc} {face_area}")
+        case _:
+            raise ValueError(f"Unknown border {border}")
 
-    return (output_string_north, output_string_east, output_string_south, output_string_west)
+    return output_string
@@ -4,85 +4,444 @@ This stage generates all necessary input files to run PFLOTRAN simulations, i.e.
 files, the `pflotran.in` file and also any `.h5` files.
 """
 
+import functools
+import hashlib
 import logging
+import os
 import pathlib
 import warnings
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from typing import Any
 
 import jinja2
 import numpy as np
-from h5py import File
+from h5py import ExternalLink, File
+from pydantic_core import to_json
 
 # This supresses unwanted output as the library tries to write to its installation directory
 with warnings.catch_warnings(action="ignore"):
     from numpydantic import NDArray
 
-from ...data_structures import HeatPump, State, ValueXYZ
+from ...data_structures import Compression, Data, DataPoint, GeneralConfig, GridType, HeatPump, State, ValueXYZ
 from ...variation_stage.vary_perlin import create_const_field
-from .pflotran_generate_mesh import write_mesh_and_border_files
+from .pflotran_generate_mesh import MESH_FILES, mesh_cache_key, write_mesh_and_border_files
+
+DEFAULT_FIELD_CHUNK_SIZE = 2**16
+"""
+The number of cells per chunk of compressed field datasets, if
+`vampireman.data_structures.GeneralConfig.field_chunk_size` is not set.
+"""
+
+RENDER_SETTINGS = {
+    "number_cells",
+    "cell_resolution",
+    "grid_type",
+    "precision",
+    "field_compression",
+    "field_compression_level",
+    "field_shuffle",
+    "field_chunk_size",
+    "time_to_simulate",
+    "sim_tool",
+}
+"""
+The `vampireman.data_structures.GeneralConfig` settings that reach the rendered files of a data point, either through
+the template or through the fields, so they are part of its fingerprint, see `render_fingerprint`.
+All other settings, e.g., of the simulation or visualization stage, don't change the rendered files.
+The settings of the variation stage don't either, as they only change the rendered files through the values of the
+data point, which are part of the fingerprint themselves.
+"""
 
 
 def render_stage(state: State):
     """
     Render all files needed for pflotran to run.
     This means, `write_mesh_and_border_files`, rendering the pflotran.in file and rendering the permeability field with
-    `save_vary_field`.
+    `write_vary_field`.
+    A constant permeability is passed to PFLOTRAN as a scalar in the pflotran.in file, so no field is rendered for it.
+    For a `vampireman.data_structures.GridType.STRUCTURED` grid, PFLOTRAN generates the grid itself, so no mesh and
+    boundary files are written.
+
+    With more than one `vampireman.data_structures.GeneralConfig.number_workers`, the pflotran.in files are rendered
+    and written by a process pool, while the main process writes the permeability fields.
+    The files are the same either way.
+
+    With `vampireman.data_structures.GeneralConfig.incremental_render`, the files of data points whose fingerprint
+    didn't change since they were rendered last are not written again, see `render_fingerprint`.
+    """
+
+    write_shared_files(state)
+
+    if state.general.number_workers == 1:
+        for datapoint in state.datapoints:
+            render_datapoint(state, datapoint)
+        return
+
+    with ProcessPoolExecutor(max_workers=state.general.number_workers) as executor:
+        pending = [render_datapoint(state, datapoint, executor) for datapoint in state.datapoints]
+        for future in pending:
+            if future is not None:
+                future.result()
+
+
+def render_datapoints(state: State, datapoints: Iterable[DataPoint]) -> Iterator[DataPoint]:
+    """
+    Does the same as `render_stage`, but for one `vampireman.data_structures.DataPoint` after the other, yielding each
+    of them once its files are rendered.
+    """
+
+    write_shared_files(state)
+    for datapoint in datapoints:
+        render_datapoint(state, datapoint)
+        yield datapoint
+
+
+def write_shared_files(state: State):
+    """
+    Writes the files that all data points share, i.e., the mesh and boundary files.
+    With `vampireman.data_structures.GeneralConfig.incremental_render`, they are only written if the grid changed.
     """
 
-    write_mesh_and_border_files(state, state.general.output_directory)
+    if state.general.grid_type == GridType.UNSTRUCTURED_EXPLICIT:
+        output_dir = state.general.output_directory
+        fingerprint = mesh_cache_key(state)
+        if state.general.incremental_render and is_up_to_date(output_dir / "mesh.fingerprint", fingerprint, MESH_FILES):
+            logging.info("The mesh and boundary files are up to date")
+            return
+
+        (output_dir / "mesh.fingerprint").unlink(missing_ok=True)
+        write_mesh_and_border_files(state, output_dir)
+        (output_dir / "mesh.fingerprint").write_text(fingerprint)
+
+
+@functools.cache
+def get_template() -> jinja2.Template:
+    """
+    Returns the pflotran.in template.
+    It is only compiled once per process, and the compiled template is cached on disk by jinja2, in a directory in the
+    temporary directory of the system, so other processes, e.g., the workers of `render_stage`, or later runs don't
+    need to compile it again.
+    """
 
     LoggingUndefined = jinja2.make_logging_undefined(logger=logging.getLogger())
     env = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(pathlib.Path(__file__).parent / "templates"), undefined=LoggingUndefined
+        loader=jinja2.FileSystemLoader(pathlib.Path(__file__).parent / "templates"),
+        undefined=LoggingUndefined,
+        bytecode_cache=jinja2.FileSystemBytecodeCache(),
     )
-    template = env.get_template("pflotran.in.j2")
+    return env.get_template("pflotran.in.j2")
 
-    for index, datapoint in enumerate(state.datapoints):
-        datapoint_dir = state.general.output_directory / f"datapoint-{index}"
 
-        # Ensure pressure_gradient is x, y, z
-        pressure_gradient = datapoint.data["pressure_gradient"]
-        if isinstance(pressure_gradient.value, float):
-            pressure_gradient.value = ValueXYZ(x=0, y=pressure_gradient.value, z=0)
+def render_datapoint(state: State, datapoint: DataPoint, executor: Executor | None = None) -> None | Future[None]:
+    """
+    Renders the permeability field and the pflotran.in file of one `vampireman.data_structures.DataPoint`.
+    A constant permeability is rendered into the pflotran.in file instead of a field file.
+    If an `executor` is given, the pflotran.in file is rendered by it and the `concurrent.futures.Future` is returned.
 
-        # Handle permeability
-        permeability = datapoint.data["permeability"]
+    The `render_fingerprint` of the data point is written to its "render.fingerprint" file after all of its files were
+    written.
+    With `vampireman.data_structures.GeneralConfig.incremental_render`, nothing is written if the fingerprint matches.
+    """
+
+    datapoint_dir = state.general.output_directory / f"datapoint-{datapoint.index}"
+
+    # Ensure pressure_gradient is x, y, z
+    pressure_gradient = datapoint.data["pressure_gradient"]
+    if isinstance(pressure_gradient.value, float):
+        pressure_gradient.value = ValueXYZ(x=0, y=pressure_gradient.value, z=0)
+
+    # Handle permeability
+    permeability = datapoint.data["permeability"]
+    fields: dict[str, str] = {}
 
+    if np.size(permeability.value) == 1:  # pyright: ignore[reportArgumentType]
+        # A constant permeability is rendered into the pflotran.in file as a scalar, so no field is needed
+        permeability.value = np.asarray(permeability.value).item()
+    else:
         # Is the permeability already a 3d field? If not, create one
-        if isinstance(permeability.value, float | NDArray):  # pyright: ignore[reportArgumentType]
+        if isinstance(permeability.value, NDArray):  # pyright: ignore[reportArgumentType]
             permeability.value = create_const_field(state, permeability.value)  # pyright: ignore[reportArgumentType]
+        fields[permeability.name] = field_hash(state, permeability.value, permeability.name)  # pyright: ignore[reportArgumentType]
 
-        save_vary_field(
-            datapoint_dir / "permeability_field.h5",
-            state.general.number_cells,
-            permeability.value,
-            permeability.name,
-        )
+    heatpumps = [{name: d.value} for name, d in datapoint.data.items() if isinstance(d.value, HeatPump)]
 
-        heatpumps = [{name: d.value} for name, d in datapoint.data.items() if isinstance(d.value, HeatPump)]
+    values = datapoint.data
+    values["heatpumps"] = heatpumps  # type: ignore
+    values["time_to_simulate"] = state.general.time_to_simulate  # type: ignore
+    values["general"] = state.general  # type: ignore
 
-        values = datapoint.data
-        values["heatpumps"] = heatpumps  # type: ignore
-        values["time_to_simulate"] = state.general.time_to_simulate  # type: ignore
+    # The fields are not used in the template, so don't pass them to other processes
+    context = {
+        name: value
+        for name, value in values.items()
+        if not (isinstance(value, Data) and isinstance(value.value, np.ndarray))
+    }
 
-        with open(f"{datapoint_dir}/pflotran.in", "w") as file:
-            file.write(template.render(values))
-            logging.debug("Rendered pflotran-%s.in", index)
+    fingerprint = render_fingerprint(state, context, fields)
+    fingerprint_file = datapoint_dir / "render.fingerprint"
+    files = ["pflotran.in", *(f"{name}_field.h5" for name in fields)]
+    if state.general.incremental_render and is_up_to_date(fingerprint_file, fingerprint, files):
+        logging.debug("Datapoint %s is up to date", datapoint.index)
+        return None
 
+    # Remove the old fingerprint first, so it can't match files that were only partly rewritten
+    fingerprint_file.unlink(missing_ok=True)
+    for name, content_hash in fields.items():
+        field = datapoint.data[name].value
+        write_vary_field(state, datapoint_dir / f"{name}_field.h5", field, name, content_hash)  # pyright: ignore
 
-def save_vary_field(filename, number_cells, cells, parameter_name: str = "permeability"):
+    if executor is None:
+        write_pflotran_in(datapoint_dir, context, fingerprint)
+        return None
+    return executor.submit(write_pflotran_in, datapoint_dir, context, fingerprint)
+
+
+def write_pflotran_in(datapoint_dir: pathlib.Path, context: dict[str, Any], fingerprint: str | None = None):
+    """
+    Renders the pflotran.in template with the `context` into the `datapoint_dir`.
+    Then the `fingerprint` is written, if given, as the data point is completely rendered.
+    """
+
+    with open(datapoint_dir / "pflotran.in", "w") as file:
+        file.write(get_template().render(context))
+    logging.debug("Rendered %s", datapoint_dir / "pflotran.in")
+
+    if fingerprint is not None:
+        (datapoint_dir / "render.fingerprint").write_text(fingerprint)
+
+
+@functools.cache
+def template_hash() -> str:
+    """
+    Returns the hash of the source of the pflotran.in template.
+    """
+
+    return hashlib.sha256((pathlib.Path(__file__).parent / "templates" / "pflotran.in.j2").read_bytes()).hexdigest()
+
+
+def render_fingerprint(state: State, context: dict[str, Any], fields: dict[str, str]) -> str:
+    """
+    Returns the fingerprint of the rendered files of a data point, i.e., a hash of everything they are rendered from:
+    the `template_hash`, the template `context` of the data point, the `field_hash` of each of its `fields`, and the
+    `RENDER_SETTINGS` of the `vampireman.data_structures.GeneralConfig`, which include the grid.
+    """
+
+    content = {name: value for name, value in context.items() if name != "general"}
+    content["general"] = state.general.model_dump(mode="json", include=RENDER_SETTINGS, warnings=False)
+
+    fingerprint = hashlib.sha256(template_hash().encode())
+    fingerprint.update(to_json(content, fallback=repr))
+    fingerprint.update(to_json(fields))
+    return fingerprint.hexdigest()
+
+
+def is_up_to_date(fingerprint_file: pathlib.Path, fingerprint: str, files: Iterable[str]) -> bool:
+    """
+    Checks if the `fingerprint_file` holds the `fingerprint` and all of the `files` next to it exist.
+    """
+
+    try:
+        if fingerprint_file.read_text() != fingerprint:
+            return False
+    except FileNotFoundError:
+        return False
+    return all((fingerprint_file.parent / file).exists() for file in files)
+
+
+def field_hash(state: State, cells: np.ndarray, parameter_name: str = "permeability") -> str:
+    """
+    Returns the hash a field file is stored under by `write_vary_field`.
+    It covers the content of the field and the options it is stored with, see `field_dataset_options`.
+    """
+
+    dataset_options = field_dataset_options(state.general, cells.size)
+    content = hashlib.sha256(
+        f"{parameter_name}:{cells.dtype.str}:{cells.shape}:{sorted(dataset_options.items())}:".encode()
+    )
+    content.update(np.ascontiguousarray(cells).data)
+    return content.hexdigest()[:32]
+
+
+def write_vary_field(
+    state: State,
+    filename: pathlib.Path,
+    cells: np.ndarray,
+    parameter_name: str = "permeability",
+    content_hash: str | None = None,
+):
+    """
+    Writes the `.h5` field file for the given `parameter_name` to `filename`, without writing the same field twice.
+
+    All field files are stored in the "fields" directory of the data set, named by their `field_hash`, and `filename`
+    is a hardlink to the matching one.
+    The `content_hash` can be passed if the `field_hash` was calculated already.
+    So data points with the same field, e.g., a constant or fixed permeability, share one file on disk.
+    The "Cell Ids" are only stored once per grid as well, see `write_cell_ids`.
+    Where hardlinks are not supported, `filename` is a small file with HDF5 external links to the shared datasets.
+    """
+
+    fields_dir = state.general.output_directory / "fields"
+    fields_dir.mkdir(exist_ok=True)
+    dataset_options = field_dataset_options(state.general, cells.size)
+    cell_ids_file = write_cell_ids(fields_dir, state.general.number_cells, dataset_options)
+
+    if content_hash is None:
+        content_hash = field_hash(state, cells, parameter_name)
+    field_file = fields_dir / f"{parameter_name}_field-{content_hash}.h5"
+
+    if not field_file.exists():
+        temporary = unique_temporary_path(field_file)
+        save_vary_field(temporary, state.general.number_cells, cells, parameter_name, cell_ids_file, dataset_options)
+        os.replace(temporary, field_file)
+    else:
+        logging.debug(f"Reusing the {parameter_name}-field {field_file.name}")
+
+    temporary = unique_temporary_path(filename)
+    try:
+        os.link(field_file, temporary)
+    except OSError:
+        with File(temporary, mode="w") as h5file:
+            h5file["Cell Ids"] = ExternalLink(relative_field_path(cell_ids_file), "Cell Ids")
+            h5file[parameter_name.title()] = ExternalLink(relative_field_path(field_file), parameter_name.title())
+    os.replace(temporary, filename)
+
+
+def write_cell_ids(
+    fields_dir: pathlib.Path, number_cells, dataset_options: dict[str, Any] | None = None
+) -> pathlib.Path:
+    """
+    Writes the 1-based "Cell Ids" of the grid with `number_cells` into the `fields_dir`, if they are not there yet.
+    The dataset is created with the `dataset_options` from `field_dataset_options`.
+    Returns the path of the file.
+    """
+
+    cell_ids_file = fields_dir / f"cell_ids-{number_cells[0]}x{number_cells[1]}x{number_cells[2]}.h5"
+    if not cell_ids_file.exists():
+        n = number_cells[0] * number_cells[1] * number_cells[2]
+        # create integer array for cell ids
+        iarray = np.arange(1, n + 1, dtype="i4")  # 1-based
+
+        temporary = unique_temporary_path(cell_ids_file)
+        with File(temporary, mode="w") as h5file:
+            h5file.create_dataset("Cell Ids", data=iarray, **(dataset_options or {}))
+        os.replace(temporary, cell_ids_file)
+
+    return cell_ids_file
+
+
+def relative_field_path(path: pathlib.Path) -> str:
+    """
+    Returns the path of a file in the "fields" directory relative to any directory next to it, e.g., a data point
+    directory.
+    HDF5 resolves relative external links from the directory of the file containing the link, so the same link works in
+    the "fields" directory and in every data point directory.
+    """
+
+    return f"../{path.parent.name}/{path.name}"
+
+
+def unique_temporary_path(path: pathlib.Path) -> pathlib.Path:
+    """
+    Returns a temporary path next to `path`, to write a file there first and then move it to `path` atomically.
+    """
+
+    return path.with_name(f".{path.name}.{os.getpid()}.tmp")
+
+
+def field_dataset_options(general: GeneralConfig, size: int) -> dict[str, Any]:
+    """
+    Returns the keyword arguments for `h5py.Group.create_dataset` to store a field with `size` cells with the chunking
+    and compression configured in `general`.
+    """
+
+    options: dict[str, Any] = {}
+    if general.field_compression == Compression.GZIP:
+        options["compression"] = "gzip"
+        options["compression_opts"] = general.field_compression_level
+    elif general.field_compression == Compression.LZF:
+        options["compression"] = "lzf"
+    if general.field_shuffle:
+        options["shuffle"] = True
+
+    chunk_size = general.field_chunk_size
+    if chunk_size is None and options:
+        # Filters only work on chunked datasets
+        chunk_size = DEFAULT_FIELD_CHUNK_SIZE
+    if chunk_size is not None:
+        options["chunks"] = (min(chunk_size, size),)
+
+    return options
+
+
+def fortran_order_chunks(cells: np.ndarray, chunk_size: int) -> Iterator[tuple[int, np.ndarray]]:
+    """
+    Yields the three dimensional `cells` flattened in Fortran order, i.e., with the first axis changing fastest, which
+    is the order of the cell ids.
+    The values are yielded as `(offset, values)` with `chunk_size` values each (except for the last ones), so they align
+    with the chunks of a dataset with the same chunk size.
+
+    Only one chunk is copied at a time, instead of the whole field, and nothing is copied if `cells` already is in
+    Fortran order.
+    """
+
+    size = cells.size
+    if cells.flags.f_contiguous:
+        flat = cells.reshape(size, order="F")
+        for start in range(0, size, chunk_size):
+            yield start, flat[start : start + chunk_size]
+        return
+
+    nx, ny, _ = cells.shape
+    for start in range(0, size, chunk_size):
+        end = min(size, start + chunk_size)
+        parts = []
+        position = start
+        while position < end:
+            k, rest = divmod(position, nx * ny)
+            j, i = divmod(rest, nx)
+            if i == 0 and end - position >= nx:
+                # Whole rows of the layer k
+                rows = min((end - position) // nx, ny - j)
+                parts.append(cells[:, j : j + rows, k].T.ravel())
+            else:
+                parts.append(cells[i : i + min(end - position, nx - i), j, k])
+            position += parts[-1].size
+        yield start, parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+
+def save_vary_field(
+    filename,
+    number_cells,
+    cells,
+    parameter_name: str = "permeability",
+    cell_ids_file: pathlib.Path | None = None,
+    dataset_options: dict[str, Any] | None = None,
+):
     """
     Writes the `.h5` field file for the given `parameter_name`.
     The values for the file were calculated during the variation stage.
+    If a `cell_ids_file` written by `write_cell_ids` is given, the "Cell Ids" are an external link to it instead of a
+    copy.
+    The datasets are created with the `dataset_options` from `field_dataset_options` and the field is written chunk by
+    chunk with `fortran_order_chunks`.
     """
 
     n = number_cells[0] * number_cells[1] * number_cells[2]
-    # create integer array for cell ids
-    iarray = np.arange(n, dtype="i4")
-    iarray[:] += 1  # convert to 1-based
-    cells_array_flatten = cells.reshape(n, order="F")
+    dataset_options = dataset_options or {}
+    cells = cells.reshape(tuple(number_cells))
 
     with File(filename, mode="w") as h5file:
-        h5file.create_dataset("Cell Ids", data=iarray)
-        h5file.create_dataset(parameter_name.title(), data=cells_array_flatten)
+        if cell_ids_file is None:
+            # create integer array for cell ids
+            iarray = np.arange(1, n + 1, dtype="i4")  # 1-based
+            h5file.create_dataset("Cell Ids", data=iarray, **dataset_options)
+        else:
+            h5file["Cell Ids"] = ExternalLink(relative_field_path(cell_ids_file), "Cell Ids")
+
+        dataset = h5file.create_dataset(parameter_name.title(), shape=(n,), dtype=cells.dtype, **dataset_options)
+        chunk_size = dataset.chunks[0] if dataset.chunks else DEFAULT_FIELD_CHUNK_SIZE
+        for start, values in fortran_order_chunks(cells, chunk_size):
+            dataset[start : start + values.size] = values
 
     logging.info(f"Created a {parameter_name}-field")
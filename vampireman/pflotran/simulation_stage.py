@@ -1,46 +1,421 @@
+import asyncio
+import contextlib
+import dataclasses
+import functools
 import logging
 import os
+import signal
 import subprocess
-import sys
+import threading
+import time
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, Future, wait
+from typing import IO
 
-from ..data_structures import State
+from pydantic import BaseModel, TypeAdapter
+
+from ..data_structures import DataPoint, State
+from ..simulation_stage import FAILED_SIMULATIONS_FILE
 from ..utils import get_answer
 
+TERMINATION_GRACE_PERIOD = 10.0
+"""
+The seconds a simulation gets to exit after it was asked to terminate, e.g., after a timeout, before it is killed.
+"""
+
+TRANSIENT_EXIT_CODES = {-signal.SIGKILL, 128 + signal.SIGKILL}
+"""
+The exit codes of simulations that were killed with SIGKILL, e.g., by the out-of-memory killer, directly or as reported
+by mpirun.
+Other signals, like SIGABRT from a failed assertion in PFLOTRAN, are usually caused by the input files, so they would
+happen again.
+"""
+
+
+class SimulationResult(BaseModel):
+    """
+    The outcome of the simulation of one data point, see `supervise_simulation`.
+    """
+
+    index: int
+    """
+    The index of the data point.
+    """
+
+    exit_code: None | int = None
+    """
+    The exit code of the last attempt, negative if it was terminated by a signal.
+    """
+
+    timed_out: bool = False
+    """
+    Whether the last attempt exceeded `vampireman.data_structures.GeneralConfig.simulation_timeout`.
+    """
+
+    attempts: int = 0
+    """
+    How often the simulation was started.
+    """
+
+    log_file: str = ""
+    """
+    The file the output of the simulation was written to.
+    """
+
+    @property
+    def succeeded(self) -> bool:
+        return self.exit_code == 0 and not self.timed_out
+
+    @property
+    def transient(self) -> bool:
+        """
+        Whether the failure may not happen again, so the simulation is retried.
+        This is the case if it timed out or was killed, see `TRANSIENT_EXIT_CODES`.
+        """
+
+        return self.timed_out or self.exit_code in TRANSIENT_EXIT_CODES
+
+
+@dataclasses.dataclass
+class SimulationProgress:
+    """
+    Keeps track of the finished simulations and logs the progress, the throughput and the estimated time left.
+    """
+
+    total: int
+    started_at: float = dataclasses.field(default_factory=time.monotonic)
+    finished: int = 0
+    skipped: int = 0
+    failures: list[SimulationResult] = dataclasses.field(default_factory=list)
+
+    def skip(self):
+        self.skipped += 1
+
+    def report(self, result: SimulationResult):
+        self.finished += 1
+        if not result.succeeded:
+            self.failures.append(result)
+
+        elapsed = time.monotonic() - self.started_at
+        per_hour = self.finished / elapsed * 3600
+        remaining = self.total - self.finished - self.skipped
+        logging.info(
+            "Simulated %s of %s datapoints (%s failed), %.1f datapoints/hour, about %s left",
+            self.finished + self.skipped,
+            self.total,
+            len(self.failures),
+            per_hour,
+            format_duration(remaining / per_hour * 3600),
+        )
+
 
 def simulation_stage(state: State):
     """
-    Runs the pflotran simulation.
-    The function changes the cwd into each of the datapoints directories.
-    Then, in the respective datapoint dir, it runs the pflotran simulation either with mpirun or directly depending on
-    `vampireman.data_structures.GeneralConfig.mpirun`.
+    Runs the pflotran simulations.
+    Each simulation runs in the directory of its data point, either with mpirun or directly depending on
+    `vampireman.data_structures.GeneralConfig.mpirun`, and up to `simulation_jobs` simulations run at once, see
+    `run_simulations`.
+    """
+
+    for _ in run_simulations(state, range(state.general.number_datapoints)):
+        pass
+
+
+def simulate_datapoints(state: State, datapoints: Iterable[DataPoint]) -> Iterator[DataPoint]:
+    """
+    Does the same as `simulation_stage`, but for the `vampireman.data_structures.DataPoint`s as they come in, yielding
+    each of them once its simulation succeeded.
+    """
+
+    pending: dict[int, DataPoint] = {}
+
+    def indices() -> Iterator[int]:
+        for datapoint in datapoints:
+            pending[datapoint.index] = datapoint
+            yield datapoint.index
+
+    for index, succeeded in run_simulations(state, indices()):
+        # Failed data points are dropped right away, so they don't pile up in long runs
+        datapoint = pending.pop(index)
+        if succeeded:
+            yield datapoint
+
+
+def simulation_jobs(state: State) -> int:
+    """
+    Returns the number of simulations to run at once.
+    This is `vampireman.data_structures.GeneralConfig.simulation_jobs` if set, otherwise as many as fit on the cores
+    available to this process, i.e., the number of cores divided by the cores one simulation uses.
+    """
+
+    if state.general.simulation_jobs is not None:
+        return state.general.simulation_jobs
+
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+
+    if not state.general.mpirun:
+        return cores
+    if state.general.mpirun_procs is None:
+        # mpirun uses all cores
+        return 1
+    return max(1, cores // state.general.mpirun_procs)
+
+
+def run_simulations(state: State, indices: Iterable[int]) -> Iterator[tuple[int, bool]]:
+    """
+    Runs the simulations of the data points with the given `indices`, yielding each index once its simulation
+    finished, in the order the simulations finish, along with whether it succeeded.
+    Up to `simulation_jobs` simulations run at once as asyncio subprocesses, supervised by `supervise_simulation` in
+    an event loop in a background thread.
+    The next index is only taken from `indices` when a simulation can be started, so `indices` may be a generator that
+    produces the data points on demand.
+    The progress is logged as the simulations finish, see `SimulationProgress`.
+
+    Simulations that failed, even after retrying them, don't stop the others.
+    They are listed in the `vampireman.simulation_stage.FAILED_SIMULATIONS_FILE`, see
+    `write_failures`.
     """
 
-    original_dir = os.getcwd()
+    jobs = simulation_jobs(state)
+    logging.info("Running up to %s simulations at once", jobs)
+    progress = SimulationProgress(total=state.general.number_datapoints)
+    write_failures(state, [])
 
-    for index in range(state.general.number_datapoints):
-        datapoint_path = state.general.output_directory / f"datapoint-{index}"
-        os.chdir(datapoint_path)
-        if os.path.isfile("pflotran.out") and os.path.isfile("pflotran.h5"):
-            logging.warning(f"pflotran.out and pflotran.h5 files present in {datapoint_path}")
-            if not get_answer(state, "Looks like the simulation already ran, run simulation again?"):
-                os.chdir(original_dir)
+    with event_loop_thread() as loop:
+        running: dict[Future[SimulationResult], int] = {}
+        for index in indices:
+            if not needs_simulation(state, index):
+                progress.skip()
+                yield index, True
                 continue
 
-        command: list[str] = []
-        if state.general.mpirun:
-            command += ["mpirun"]
-            if state.general.mpirun_procs:
-                command += ["-n", str(state.general.mpirun_procs)]
-            command += ["--"]  # Ends the command inputs for mpirun
-        command += ["pflotran"]
-        if state.general.mute_simulation_output:
-            command += ["-screen_output", "off"]
-        try:
-            subprocess.run(command, check=True, close_fds=True)
-        except subprocess.CalledProcessError:
-            logging.critical(f"There was an error during executing the command `{" ".join(command)}`.")
-            logging.critical(f"Please check the logs at '{datapoint_path}/pflotran.out'")
-            sys.exit(1)
-
-        # always go back to the original_dir as we use relative paths
-        os.chdir(original_dir)
+            if len(running) == jobs:
+                yield from wait_for_simulations(state, running, progress, FIRST_COMPLETED)
+            running[asyncio.run_coroutine_threadsafe(supervise_simulation(state, index, jobs), loop)] = index
+
+        yield from wait_for_simulations(state, running, progress, ALL_COMPLETED)
+
+    if progress.failures:
+        logging.error(
+            "The simulations of %s datapoints failed: %s",
+            len(progress.failures),
+            ", ".join(str(result.index) for result in progress.failures),
+        )
+
+
+def wait_for_simulations(
+    state: State, running: dict[Future[SimulationResult], int], progress: SimulationProgress, return_when: str
+) -> Iterator[tuple[int, bool]]:
+    """
+    Waits for the `running` simulations as given by `return_when` (see `concurrent.futures.wait`), removes the finished
+    ones from `running`, reports them to the `progress` and yields their indices and whether they succeeded.
+    """
+
+    done, _ = wait(running, return_when=return_when)
+    for future in done:
+        del running[future]
+        result = future.result()
+        progress.report(result)
+        if not result.succeeded:
+            write_failures(state, progress.failures)
+        yield result.index, result.succeeded
+
+
+def write_failures(state: State, failures: list[SimulationResult]):
+    """
+    Writes the `failures` to the `vampireman.simulation_stage.FAILED_SIMULATIONS_FILE`, or removes it if there are
+    none.
+    The file is replaced atomically, so it is always complete, even if VampireMan is interrupted.
+    """
+
+    manifest = state.general.output_directory / FAILED_SIMULATIONS_FILE
+    if not failures:
+        manifest.unlink(missing_ok=True)
+        return
+
+    temporary = manifest.with_name(f".{manifest.name}.tmp")
+    temporary.write_bytes(TypeAdapter(list[SimulationResult]).dump_json(failures, indent=2))
+    os.replace(temporary, manifest)
+
+
+def needs_simulation(state: State, index: int) -> bool:
+    """
+    Checks if the data point with the given `index` needs to be simulated.
+    If it was simulated already, the user is asked whether to run the simulation again.
+    """
+
+    datapoint_path = state.general.output_directory / f"datapoint-{index}"
+    if (datapoint_path / "pflotran.out").is_file() and (datapoint_path / "pflotran.h5").is_file():
+        logging.warning(f"pflotran.out and pflotran.h5 files present in {datapoint_path}")
+        return get_answer(state, "Looks like the simulation already ran, run simulation again?")
+    return True
+
+
+def simulation_command(state: State, jobs: int = 1) -> list[str]:
+    """
+    Returns the command that runs one simulation, when `jobs` simulations run at once.
+    """
+
+    command: list[str] = []
+    if state.general.mpirun:
+        command += ["mpirun"]
+        if state.general.mpirun_procs:
+            command += ["-n", str(state.general.mpirun_procs)]
+        if jobs > 1 and mpirun_is_open_mpi():
+            # Open MPI would bind the ranks of all simulations to the same cores
+            command += ["--bind-to", "none"]
+        command += ["--"]  # Ends the command inputs for mpirun
+    command += ["pflotran"]
+    if state.general.mute_simulation_output:
+        command += ["-screen_output", "off"]
+    return command
+
+
+@functools.cache
+def mpirun_is_open_mpi() -> bool:
+    """
+    Checks if the `mpirun` on the PATH is the one of Open MPI, based on its version output.
+    Other MPI implementations, e.g., MPICH, don't bind the ranks to cores by default and don't know Open MPI's options.
+    """
+
+    try:
+        process = subprocess.run(
+            ["mpirun", "--version"], stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=60
+        )
+    except (OSError, subprocess.SubprocessError):
+        return False
+    return "Open MPI" in process.stdout + process.stderr
+
+
+async def supervise_simulation(state: State, index: int, jobs: int = 1) -> SimulationResult:
+    """
+    Runs the pflotran simulation of the data point with the given `index` in its directory, out of `jobs` simulations
+    that run at once.
+    A run that takes longer than `vampireman.data_structures.GeneralConfig.simulation_timeout` is terminated, and runs
+    that failed transiently (see `SimulationResult.transient`) are retried up to
+    `vampireman.data_structures.GeneralConfig.simulation_retries` times.
+    The output of all attempts is written to the "simulation.log" file of the data point.
+    """
+
+    datapoint_path = state.general.output_directory / f"datapoint-{index}"
+    command = simulation_command(state, jobs)
+    result = SimulationResult(index=index, log_file=str(datapoint_path / "simulation.log"))
+
+    # Opening a file may block, e.g., on a network file system, which would hold up the other simulations
+    log_file = await asyncio.to_thread(open, result.log_file, "w")
+    with log_file:
+        for attempt in range(1, state.general.simulation_retries + 2):
+            if attempt > 1:
+                logging.warning("Retrying the simulation of datapoint %s, attempt %s", index, attempt)
+                log_file.write(f"\n=== Attempt {attempt} ===\n")
+                log_file.flush()
+            else:
+                logging.info("Simulating datapoint %s", index)
+
+            result.attempts = attempt
+            result.exit_code, result.timed_out = await run_process(
+                command, datapoint_path, log_file, state.general.simulation_timeout
+            )
+            if result.succeeded or not result.transient:
+                break
+
+    if result.succeeded:
+        logging.info("Finished simulating datapoint %s", index)
+    else:
+        reason = "timed out" if result.timed_out else f"failed with exit code {result.exit_code}"
+        logging.error(
+            "The simulation of datapoint %s %s (attempts: %s), please check the logs at '%s' and '%s'",
+            index,
+            reason,
+            result.attempts,
+            result.log_file,
+            datapoint_path / "pflotran.out",
+        )
+    return result
+
+
+async def run_process(
+    command: list[str], cwd: os.PathLike, log_file: IO[str], timeout: float | None
+) -> tuple[int | None, bool]:
+    """
+    Runs the `command` in the `cwd` with its output written to the `log_file`, for at most `timeout` seconds.
+    The process runs in its own session, so it can be terminated together with its children, e.g., the ranks started
+    by mpirun.
+    Returns the exit code and whether the process timed out.
+    """
+
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        cwd=cwd,
+        stdin=subprocess.DEVNULL,
+        stdout=log_file,
+        stderr=subprocess.STDOUT,
+        start_new_session=True,
+    )
+    try:
+        return await asyncio.wait_for(process.wait(), timeout), False
+    except TimeoutError:
+        logging.warning("The simulation in %s timed out after %s seconds", cwd, timeout)
+        await terminate(process)
+        return process.returncode, True
+    except asyncio.CancelledError:
+        await terminate(process)
+        raise
+
+
+async def terminate(process: asyncio.subprocess.Process):
+    """
+    Terminates the `process` and all processes in its session, and kills them if they don't exit within the
+    `TERMINATION_GRACE_PERIOD`.
+    """
+
+    with contextlib.suppress(ProcessLookupError):
+        os.killpg(process.pid, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(process.wait(), TERMINATION_GRACE_PERIOD)
+    except TimeoutError:
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(process.pid, signal.SIGKILL)
+        await process.wait()
+
+
+@contextlib.contextmanager
+def event_loop_thread() -> Iterator[asyncio.AbstractEventLoop]:
+    """
+    Runs an asyncio event loop in a background thread, so coroutines can be started on it from the synchronous stages
+    with `asyncio.run_coroutine_threadsafe`.
+    When the context is left, e.g., by an exception or a `KeyboardInterrupt`, all tasks still running on the loop are
+    cancelled and waited for, so no simulation keeps running, before the loop is stopped.
+    """
+
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, name="simulation-supervisor", daemon=True)
+    thread.start()
+    try:
+        yield loop
+    finally:
+        asyncio.run_coroutine_threadsafe(cancel_tasks(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+async def cancel_tasks():
+    """
+    Cancels all other tasks of the running event loop and waits for them.
+    """
+
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def format_duration(seconds: float) -> str:
+    """
+    Formats a number of seconds as hours, minutes and seconds, e.g., 3725 as "1:02:05".
+    """
+
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}"
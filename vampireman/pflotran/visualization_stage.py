@@ -9,6 +9,7 @@ It reads in pflotran.h5 files and generates three images:
 
 import logging
 from collections import OrderedDict
+from collections.abc import Iterable, Iterator
 from pathlib import Path
 from typing import Any, cast
 
@@ -18,7 +19,8 @@ import matplotlib.ticker as ticker
 import numpy as np
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 
-from ..data_structures import Data, State
+from ..data_structures import Data, DataPoint, State
+from ..variation_stage.vary_perlin import create_const_field
 
 TimeData = OrderedDict[str, dict[str, Any]]
 """
@@ -47,14 +49,48 @@ def visualization_stage(state: State):
     # XXX: Could probably run in separate threads, but need to handle case of num_datapoints > num_processors
     for datapoint in state.datapoints:
         datapoint_path = state.general.output_directory / f"datapoint-{datapoint.index}"
+        if not (datapoint_path / "pflotran.h5").is_file():
+            logging.warning("Skipping datapoint %s as there are no simulation results", datapoint.index)
+            continue
+        visualize_datapoint(state, datapoint)
 
-        with h5py.File(datapoint_path / "pflotran.h5") as file:
-            list_to_plot = make_plottable(state, file)
 
-        plot_y(list_to_plot, datapoint_path)
-        plot_isolines(state, list_to_plot, datapoint_path)
-        # TODO: make this more general
-        plot_vary_field(state, datapoint_path, datapoint.data["permeability"])
+def visualize_datapoints(state: State, datapoints: Iterable[DataPoint]) -> Iterator[DataPoint]:
+    """
+    Does the same as `visualization_stage`, but for one `vampireman.data_structures.DataPoint` after the other, yielding
+    each of them once it is plotted.
+    """
+
+    for datapoint in datapoints:
+        if not state.general.skip_visualization:
+            visualize_datapoint(state, datapoint)
+        yield datapoint
+
+
+def visualize_datapoint(state: State, datapoint: DataPoint):
+    """
+    Plots the results and the permeability field of one `vampireman.data_structures.DataPoint`.
+    If the permeability field is not in the `vampireman.data_structures.DataPoint` anymore, e.g., as it was released
+    after rendering it, it is read from the rendered `permeability_field.h5` file instead.
+    A constant permeability is plotted as a constant field.
+    """
+
+    datapoint_path = state.general.output_directory / f"datapoint-{datapoint.index}"
+
+    with h5py.File(datapoint_path / "pflotran.h5") as file:
+        list_to_plot = make_plottable(state, file)
+
+    plot_y(list_to_plot, datapoint_path)
+    plot_isolines(state, list_to_plot, datapoint_path)
+
+    # TODO: make this more general
+    permeability = datapoint.data.get("permeability")
+    if permeability is None:
+        with h5py.File(datapoint_path / "permeability_field.h5") as file:
+            permeability = Data(name="permeability", value=np.array(file["Permeability"]))
+    elif isinstance(permeability.value, float | int):
+        permeability = Data(name="permeability", value=create_const_field(state, float(permeability.value)))
+    plot_vary_field(state, datapoint_path, permeability)
 
 
 def make_plottable(state: State, hdf5_file: h5py.File) -> TimeData:
@@ -184,13 +220,15 @@ def plot_vary_field(state: State, datapoint_dir: Path, parameter: Data):
     if not isinstance(parameter.value, np.ndarray):
         raise ValueError("Cannot visualize something that is not an np.ndarray")
 
-    if parameter.value.ndim != 3:
+    # Don't reassign the reshaped field to the `Data`, as the field may be shared with other data points
+    field = parameter.value
+    if field.ndim != 3:
         # Reshape the data to match the 3D space of the domain
-        parameter.value = parameter.value.reshape(cast(np.ndarray, state.general.number_cells), order="F")
+        field = field.reshape(cast(np.ndarray, state.general.number_cells), order="F")
 
-    axes[0].imshow(parameter.value[:, :, int((parameter.value.shape[2] - 1) / 2)])
-    axes[2].imshow(parameter.value[:, int((parameter.value.shape[1] - 1) / 2), :])
-    axes[3].imshow(parameter.value[int((parameter.value.shape[0] - 1) / 2), :, :])
+    axes[0].imshow(field[:, :, int((field.shape[2] - 1) / 2)])
+    axes[2].imshow(field[:, int((field.shape[1] - 1) / 2), :])
+    axes[3].imshow(field[int((field.shape[0] - 1) / 2), :, :])
     axes[0].set_title("yz")
     axes[2].set_title("xz")
     axes[3].set_title("xy")
@@ -14,19 +14,29 @@ When running interactively (depending on `vampireman.data_structures.GeneralConf
 will be interrupted after the `validation_stage` and after printing the resulting `State` object, asking the user if the
 pipeline should continue.
 If the user denies, VampireMan will exit.
+If any simulation failed, VampireMan exits with a non-zero exit code once all stages ran, see
+`exit_if_simulations_failed`.
+
+With `vampireman.data_structures.GeneralConfig.streaming`, the last four stages are chained with `run_streaming`
+instead, so each data point passes through all of them before the next one is varied.
 """
 
 import logging
+import sys
 from argparse import Namespace
+from collections.abc import Iterable, Iterator
+
+import numpy as np
 
+from .data_structures import Data, DataPoint, State
 from .loading_stage import loading_stage
 from .preparation_stage import preparation_stage
-from .render_stage import render_stage
-from .simulation_stage import simulation_stage
+from .render_stage import render_datapoints, render_stage
+from .simulation_stage import FAILED_SIMULATIONS_FILE, simulate_datapoints, simulation_stage
 from .utils import get_answer, copy_settings_to_yaml
 from .validation_stage import validation_stage
-from .variation_stage import variation_stage
-from .visualization_stage import visualization_stage
+from .variation_stage import variation_stage, vary_datapoints
+from .visualization_stage import visualization_stage, visualize_datapoints
 
 
 def run(args: Namespace):
@@ -41,6 +51,12 @@ def run(args: Namespace):
     print("This is the state that is going to be used:")
     print(state)
 
+    if state.general.streaming:
+        get_answer(state, "Do you want to run the remaining stages for one datapoint after the other?", True)
+        run_streaming(state)
+        exit_if_simulations_failed(state)
+        return
+
     get_answer(state, "Do you want to run the variation stage?", True)
     state = variation_stage(state)
 
@@ -52,3 +68,46 @@ def run(args: Namespace):
 
     get_answer(state, "Do you want to run the visualization stage?", True)
     visualization_stage(state)
+    exit_if_simulations_failed(state)
+
+
+def run_streaming(state: State):
+    """
+    Runs the variation, render, simulation and visualization stages as a chain of generators, so each data point is
+    varied, rendered, simulated and visualized before the next one is varied.
+    The fields of a data point are released as soon as they are rendered, see `release_fields`, so only the fields of
+    one data point are in memory at a time.
+    """
+
+    datapoints = vary_datapoints(state)
+    datapoints = release_fields(render_datapoints(state, datapoints))
+    datapoints = simulate_datapoints(state, datapoints)
+    datapoints = visualize_datapoints(state, datapoints)
+
+    for datapoint in datapoints:
+        logging.info("Finished datapoint %s of %s", datapoint.index + 1, state.general.number_datapoints)
+
+
+def exit_if_simulations_failed(state: State):
+    """
+    Exits with exit code 1 if the `vampireman.simulation_stage.FAILED_SIMULATIONS_FILE` exists, so scripts running
+    VampireMan notice that the data set is incomplete.
+    """
+
+    manifest = state.general.output_directory / FAILED_SIMULATIONS_FILE
+    if manifest.is_file():
+        logging.error("Some simulations failed, the data set is incomplete. They are listed in '%s'", manifest)
+        sys.exit(1)
+
+
+def release_fields(datapoints: Iterable[DataPoint]) -> Iterator[DataPoint]:
+    """
+    Removes all `vampireman.data_structures.Data` with array values from each data point, as they were written to the
+    files of the simulation tool already.
+    """
+
+    for datapoint in datapoints:
+        for name, data in list(datapoint.data.items()):
+            if isinstance(data, Data) and isinstance(data.value, np.ndarray):
+                del datapoint.data[name]
+        yield datapoint
@@ -25,8 +25,7 @@ from h5py import File
 
 from ..data_structures import HeatPump, HeatPumps, Parameter, State, ValueTimeSeries
 from ..utils import create_dataset_and_datapoint_dirs, profile_function
-from ..validation_stage.validation_stage import are_duplicate_locations_in_heatpumps
-from ..variation_stage.vary import generate_heatpump_location
+from ..variation_stage.vary import cell_id, generate_heatpump_locations
 
 
 @profile_function
@@ -87,10 +86,15 @@ def generate_heatpumps(state: State) -> State:
 
     new_heatpumps: dict[str, Parameter] = {}
 
-    # Need to get the explicit heatpumps first, in case of location clashes we can simply draw another random number
+    # Need to get the explicit heatpumps first, so the generated heatpumps can be placed in the remaining cells
+    occupied_cells: set[int] = set()
     for _, hps in state.heatpump_parameters.items():
         if isinstance(hps.value, HeatPump):
             new_heatpumps[hps.name] = hps
+            if hps.value.location is not None:
+                cell = cell_id(state, np.array(hps.value.location) - 1)
+                if cell is not None:
+                    occupied_cells.add(cell)
             continue
 
     for _, hps in state.heatpump_parameters.items():
@@ -100,6 +104,9 @@ def generate_heatpumps(state: State) -> State:
         if not isinstance(hps.value, HeatPumps):
             raise ValueError("There was a non HeatPumps item in heatpump_parameters")
 
+        # All locations are drawn at once without replacement, so they can't clash
+        locations = generate_heatpump_locations(state, hps.value.number, occupied_cells)
+
         for index in range(hps.value.number):  # type:ignore
             name = f"{hps.name}_{index}"
             if (state.heatpump_parameters.get(name) is not None) and (new_heatpumps.get(name) is not None):
@@ -110,22 +117,13 @@ def generate_heatpumps(state: State) -> State:
             injection_temp = hps.value.injection_temp
             injection_rate = hps.value.injection_rate
 
-            location = generate_heatpump_location(state)
-
             heatpump = HeatPump(
-                location=cast(list[float], location),
+                location=locations[index],
                 injection_temp=injection_temp,
                 injection_rate=injection_rate,
             )
             logging.debug("Generated HeatPump %s", heatpump)
 
-            heatpumps = cast(list[HeatPump], [param.value for _, param in new_heatpumps.items()])
-            heatpumps.append(heatpump)
-            while are_duplicate_locations_in_heatpumps(heatpumps):
-                # Generate new heatpump location if the one we had is already taken
-                # TODO write test for this
-                heatpump.location = generate_heatpump_location(state)
-
             new_heatpumps[name] = Parameter(
                 name=name,
                 vary=hps.vary,
@@ -2,7 +2,9 @@
 The render stage...
 """
 
-from ..data_structures import State
+from collections.abc import Iterable, Iterator
+
+from ..data_structures import DataPoint, State
 from ..utils import get_sim_tool_implementation, profile_function
 
 
@@ -13,3 +15,11 @@ def render_stage(state: State):
     value.
     """
     get_sim_tool_implementation(state.general.sim_tool).render_stage(state)
+
+
+def render_datapoints(state: State, datapoints: Iterable[DataPoint]) -> Iterator[DataPoint]:
+    """
+    This function runs the simulation tool specific stage for one `vampireman.data_structures.DataPoint` after the
+    other, see `vampireman.pipeline.run_streaming`.
+    """
+    return get_sim_tool_implementation(state.general.sim_tool).render_datapoints(state, datapoints)
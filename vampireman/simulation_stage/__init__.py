@@ -2,9 +2,17 @@
 The simulation stage...
 """
 
-from ..data_structures import State
+from collections.abc import Iterable, Iterator
+
+from ..data_structures import DataPoint, State
 from ..utils import get_sim_tool_implementation, profile_function
 
+FAILED_SIMULATIONS_FILE = "failed_simulations.json"
+"""
+The file in the `vampireman.data_structures.GeneralConfig.output_directory` that lists the simulations that failed.
+It only exists if there are any, see `vampireman.pipeline.exit_if_simulations_failed`.
+"""
+
 
 @profile_function
 def simulation_stage(state: State):
@@ -13,3 +21,11 @@ def simulation_stage(state: State):
     `vampireman.data_structures.GeneralConfig.sim_tool` value.
     """
     get_sim_tool_implementation(state.general.sim_tool).simulation_stage(state)
+
+
+def simulate_datapoints(state: State, datapoints: Iterable[DataPoint]) -> Iterator[DataPoint]:
+    """
+    This function runs the simulation tool specific stage for one `vampireman.data_structures.DataPoint` after the
+    other, see `vampireman.pipeline.run_streaming`.
+    """
+    return get_sim_tool_implementation(state.general.sim_tool).simulate_datapoints(state, datapoints)
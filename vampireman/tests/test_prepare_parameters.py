@@ -1,3 +1,4 @@
+import numpy as np
 import pytest
 
 from vampireman import preparation_stage
@@ -64,12 +65,52 @@ def test_prepare_heatpump_generation():
     }
     state = preparation_stage(state)
     assert len(state.heatpump_parameters) == 10
-    assert state.heatpump_parameters.get("hps_0").value.location == [102.5, 347.5, 2.5]
-    assert state.heatpump_parameters.get("hps_9").value.location == [157.5, 877.5, 2.5]
+    assert state.heatpump_parameters.get("hps_0").value.location == [137.5, 282.5, 2.5]
+    assert state.heatpump_parameters.get("hps_9").value.location == [132.5, 32.5, 2.5]
     assert len(state.heatpump_parameters.get("hps_9").value.injection_temp.values) == 1
     assert len(state.heatpump_parameters.get("hps_8").value.injection_rate.values) == 3
 
 
+def test_prepare_heatpump_generation_fills_domain():
+    state = State()
+    state.general.cell_resolution = 1.0
+    state.general.number_cells = np.array([4, 5, 3])
+    state.heatpump_parameters = {
+        "hp": Parameter(
+            name="hp",
+            vary=Vary.FIXED,
+            value=HeatPump(location=[2, 3, 1], injection_temp=10.5, injection_rate=0.002),
+        ),
+        "hps": Parameter(
+            name="hps",
+            vary=Vary.FIXED,
+            value=HeatPumps(number=59, injection_temp=14, injection_rate=0.002),
+        ),
+    }
+
+    state = preparation_stage(state)
+
+    # Every cell of the domain holds exactly one heat pump
+    locations = {tuple(parameter.value.location) for parameter in state.heatpump_parameters.values()}
+    assert len(locations) == 60
+    assert locations == {(x + 0.5, y + 0.5, z + 0.5) for x in range(4) for y in range(5) for z in range(3)}
+
+
+def test_prepare_heatpump_generation_too_many():
+    state = State()
+    state.general.number_cells = np.array([4, 5, 3])
+    state.heatpump_parameters = {
+        "hps": Parameter(
+            name="hps",
+            vary=Vary.FIXED,
+            value=HeatPumps(number=61, injection_temp=14, injection_rate=0.002),
+        ),
+    }
+
+    with pytest.raises(ValueError):
+        preparation_stage(state)
+
+
 def test_prepare_heatpump_name_clash():
     state = State()
     state.heatpump_parameters = {
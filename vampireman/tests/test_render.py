@@ -1,8 +1,29 @@
 import os
 
+import numpy as np
+import pytest
+from h5py import File
+
 from vampireman import preparation_stage, render_stage, variation_stage
-from vampireman.data_structures import State
+from vampireman.data_structures import (
+    Compression,
+    Distribution,
+    GridType,
+    HeatPumps,
+    Parameter,
+    Precision,
+    State,
+    ValueMinMax,
+    ValuePerlin,
+    Vary,
+)
+from vampireman.pflotran.render_stage import pflotran_generate_mesh
+from vampireman.pflotran.render_stage.pflotran_generate_mesh import render_mesh, write_mesh_and_border_files
+from vampireman.pflotran.render_stage.pflotran_in_renderer import fortran_order_chunks
+from vampireman.pipeline import release_fields
+from vampireman.render_stage import render_datapoints
 from vampireman.utils import create_dataset_and_datapoint_dirs
+from vampireman.variation_stage import vary_datapoints
 
 
 def test_render_borders_and_mesh(tmp_path):
@@ -52,6 +73,12 @@ def test_render_files_not_empty(tmp_path):
     state.general.interactive = False
     state.general.output_directory = tmp_path / "render_test"
     state.general.number_datapoints = 2
+    state.hydrogeological_parameters["permeability"] = Parameter(
+        name="permeability",
+        vary=Vary.SPACE,
+        distribution=Distribution.LOG,
+        value=ValuePerlin(frequency=[18, 18, 18], max=1e-9, min=1e-11),
+    )
 
     create_dataset_and_datapoint_dirs(state)
     state = preparation_stage(state)
@@ -72,3 +99,457 @@ def test_render_files_not_empty(tmp_path):
             # Check if files are not empty
             # TODO: Better test
             assert os.path.getsize(datapoint_path / file) > 0
+
+
+def test_render_mesh_matches_line_by_line_format():
+    state = State()
+    state.general.number_cells = [3, 4, 5]
+    state.general.cell_resolution = 0.1
+
+    x_grid, y_grid, z_grid = 3, 4, 5
+    resolution = 0.1
+    cells = []
+    connections = []
+    for k in range(z_grid):
+        for j in range(y_grid):
+            for i in range(x_grid):
+                cell_id = i + 1 + j * x_grid + k * x_grid * y_grid
+                x, y, z = (i + 0.5) * resolution, (j + 0.5) * resolution, (k + 0.5) * resolution
+                cells.append(f"\n{cell_id} {x} {y} {z} {resolution**3}")
+                if i < x_grid - 1:
+                    connections.append(f"\n{cell_id} {cell_id + 1} {(i + 1) * resolution} {y} {z} {resolution**2}")
+                if j < y_grid - 1:
+                    connections.append(f"\n{cell_id} {cell_id + 3} {x} {(j + 1) * resolution} {z} {resolution**2}")
+                if k < z_grid - 1:
+                    connections.append(f"\n{cell_id} {cell_id + 12} {x} {y} {(k + 1) * resolution} {resolution**2}")
+    expected = "CELLS 60" + "".join(cells) + "\nCONNECTIONS 133" + "".join(connections)
+
+    assert "".join(render_mesh(state)) == expected
+
+    # Chunks that don't line up with the z-layers must not change the output
+    state.general.mesh_chunk_size = 7
+    assert len(list(render_mesh(state))) == 2 * 10 + 3
+    assert "".join(render_mesh(state)) == expected
+
+
+def test_render_mesh_from_cache(tmp_path, monkeypatch):
+    state = State()
+    state.general.number_cells = [4, 8, 2]
+    state.general.mesh_cache_directory = tmp_path / "mesh_cache"
+
+    first_dir = tmp_path / "first"
+    first_dir.mkdir()
+    write_mesh_and_border_files(state, first_dir)
+
+    # The second data set must not render the files again
+    def fail(state):
+        raise AssertionError("mesh was rendered again")
+
+    monkeypatch.setattr(pflotran_generate_mesh, "render_mesh", fail)
+
+    second_dir = tmp_path / "second"
+    second_dir.mkdir()
+    write_mesh_and_border_files(state, second_dir)
+
+    for file in ["mesh.uge", "north.ex", "east.ex", "south.ex", "west.ex"]:
+        assert os.path.samefile(first_dir / file, second_dir / file)
+
+    with open(second_dir / "mesh.uge") as f:
+        assert f.readline() == "CELLS 64\n"
+
+    # A different grid must not hit the cache
+    state.general.cell_resolution = 2.5
+    with pytest.raises(AssertionError):
+        write_mesh_and_border_files(state, second_dir)
+
+    # The failed render leaves nothing behind in the cache
+    assert len(list((tmp_path / "mesh_cache").iterdir())) == 1
+
+
+def test_render_mesh_keeps_cache_intact(tmp_path):
+    state = State()
+    state.general.number_cells = [4, 4, 1]
+    state.general.mesh_cache_directory = tmp_path / "mesh_cache"
+    write_mesh_and_border_files(state, tmp_path)
+
+    # Rendering another grid into the same directory must not write through the hardlinks into the cache
+    state.general.number_cells = [8, 8, 1]
+    state.general.mesh_cache_directory = None
+    write_mesh_and_border_files(state, tmp_path)
+
+    (cached_dir,) = (tmp_path / "mesh_cache").iterdir()
+    with open(cached_dir / "mesh.uge") as f:
+        assert f.readline() == "CELLS 16\n"
+    with open(tmp_path / "mesh.uge") as f:
+        assert f.readline() == "CELLS 64\n"
+    for file in ["mesh.uge", "north.ex", "east.ex", "south.ex", "west.ex"]:
+        assert not os.path.samefile(cached_dir / file, tmp_path / file)
+    assert not list(tmp_path.glob(".*.tmp"))
+
+
+def test_render_structured_grid(tmp_path):
+    state = State()
+    state.general.interactive = False
+    state.general.output_directory = tmp_path / "render_test"
+    state.general.number_cells = [32, 64, 2]
+    state.general.grid_type = GridType.STRUCTURED
+
+    create_dataset_and_datapoint_dirs(state)
+    state = preparation_stage(state)
+    state = variation_stage(state)
+    render_stage(state)
+
+    for file in ["mesh.uge", "north.ex", "east.ex", "south.ex", "west.ex"]:
+        assert not os.path.exists(tmp_path / "render_test" / file)
+
+    with open(tmp_path / "render_test" / "datapoint-0" / "pflotran.in") as f:
+        pflotran_in = f.read()
+
+    assert "TYPE STRUCTURED" in pflotran_in
+    assert "NXYZ 32 64 2" in pflotran_in
+    assert "160.0 320.0 10.0" in pflotran_in
+    for face in ["NORTH", "EAST", "SOUTH", "WEST"]:
+        assert f"FACE {face}" in pflotran_in
+    assert "mesh.uge" not in pflotran_in
+    assert ".ex" not in pflotran_in
+
+
+def test_render_mesh_in_parallel(tmp_path):
+    state = State()
+    state.general.number_cells = [5, 7, 3]
+    state.general.mesh_chunk_size = 10
+
+    write_mesh_and_border_files(state, tmp_path)
+    serial = {
+        file: (tmp_path / file).read_text() for file in ["mesh.uge", "north.ex", "east.ex", "south.ex", "west.ex"]
+    }
+
+    state.general.number_workers = 3
+    parallel_dir = tmp_path / "parallel"
+    parallel_dir.mkdir()
+    write_mesh_and_border_files(state, parallel_dir)
+
+    for file, content in serial.items():
+        assert (parallel_dir / file).read_text() == content
+
+
+def test_render_pflotran_in_in_parallel(tmp_path):
+    def render(name, number_workers):
+        state = State()
+        state.general.interactive = False
+        state.general.output_directory = tmp_path / name
+        state.general.number_datapoints = 5
+        state.general.number_cells = np.array([8, 8, 1])
+        state.heatpump_parameters["hps"] = Parameter(
+            name="hps",
+            vary=Vary.FIXED,
+            value=HeatPumps(number=4, injection_temp=ValueMinMax(min=10, max=14), injection_rate=0.002),
+        )
+
+        create_dataset_and_datapoint_dirs(state)
+        state = preparation_stage(state)
+        state = variation_stage(state)
+        state.general.number_workers = number_workers
+        render_stage(state)
+
+    render("serial", 1)
+    render("parallel", 3)
+
+    for index in range(5):
+        serial = (tmp_path / "serial" / f"datapoint-{index}" / "pflotran.in").read_text()
+        parallel = (tmp_path / "parallel" / f"datapoint-{index}" / "pflotran.in").read_text()
+        assert "hps_3_region" in serial
+        assert parallel == serial
+
+
+@pytest.mark.parametrize(
+    "permeability", [np.full((32, 256, 1), 1.29e-10), ValuePerlin(frequency=[18, 18, 18], max=1e-9, min=1e-11)]
+)
+def test_render_single_precision(tmp_path, permeability):
+    state = State()
+    state.general.interactive = False
+    state.general.output_directory = tmp_path / "render_test"
+    state.general.precision = Precision.SINGLE
+
+    create_dataset_and_datapoint_dirs(state)
+    state.hydrogeological_parameters["permeability"] = Parameter(
+        name="permeability",
+        vary=Vary.SPACE if isinstance(permeability, ValuePerlin) else Vary.FIXED,
+        distribution=Distribution.LOG,
+        value=permeability,
+    )
+    state = preparation_stage(state)
+    state = variation_stage(state)
+    render_stage(state)
+
+    assert state.datapoints[0].data["permeability"].value.dtype == np.float32
+    with File(tmp_path / "render_test" / "datapoint-0" / "permeability_field.h5") as h5file:
+        assert h5file["Permeability"].dtype == np.float32
+
+
+def test_render_shared_permeability_field(tmp_path):
+    state = State()
+    state.general.interactive = False
+    state.general.output_directory = tmp_path / "render_test"
+    state.general.number_datapoints = 3
+
+    field = np.random.default_rng(0).random(state.general.number_cells) * 1e-10
+    state.hydrogeological_parameters["permeability"] = Parameter(name="permeability", vary=Vary.FIXED, value=field)
+
+    create_dataset_and_datapoint_dirs(state)
+    state = preparation_stage(state)
+    state = variation_stage(state)
+    render_stage(state)
+
+    for datapoint in state.datapoints:
+        value = datapoint.data["permeability"].value
+        assert np.shares_memory(value, field)
+        assert not value.flags.writeable
+
+        with File(tmp_path / "render_test" / f"datapoint-{datapoint.index}" / "permeability_field.h5") as h5file:
+            assert np.array_equal(h5file["Permeability"], field.reshape(-1, order="F"))
+
+    # The parameter itself can still be modified
+    field *= 2
+
+
+def test_render_streaming(tmp_path):
+    def make_state(name):
+        state = State()
+        state.general.interactive = False
+        state.general.output_directory = tmp_path / name
+        state.general.number_datapoints = 3
+        state.general.number_cells = np.array([16, 8, 2])
+
+        create_dataset_and_datapoint_dirs(state)
+        state.hydrogeological_parameters["permeability"] = Parameter(
+            name="permeability",
+            vary=Vary.SPACE,
+            distribution=Distribution.LOG,
+            value=ValuePerlin(frequency=[18, 18, 18], max=1e-9, min=1e-11),
+        )
+        return preparation_stage(state)
+
+    staged = variation_stage(make_state("staged"))
+    render_stage(staged)
+
+    streamed = make_state("streamed")
+    datapoints = list(release_fields(render_datapoints(streamed, vary_datapoints(streamed))))
+
+    assert len(streamed.datapoints) == 0
+    assert [datapoint.index for datapoint in datapoints] == [0, 1, 2]
+    for datapoint in datapoints:
+        # The fields were released once they were rendered
+        assert "permeability" not in datapoint.data
+
+        staged_dir = tmp_path / "staged" / f"datapoint-{datapoint.index}"
+        streamed_dir = tmp_path / "streamed" / f"datapoint-{datapoint.index}"
+        for file in ["pflotran.in", "datapoint.json"]:
+            assert (staged_dir / file).read_text() == (streamed_dir / file).read_text()
+        with (
+            File(staged_dir / "permeability_field.h5") as staged_file,
+            File(streamed_dir / "permeability_field.h5") as streamed_file,
+        ):
+            assert np.array_equal(staged_file["Permeability"], streamed_file["Permeability"])
+
+
+@pytest.mark.parametrize("vary", [Vary.FIXED, Vary.CONST])
+def test_render_constant_permeability_without_field(tmp_path, vary):
+    state = State()
+    state.general.interactive = False
+    state.general.output_directory = tmp_path / "render_test"
+    state.general.number_datapoints = 2
+    state.hydrogeological_parameters["permeability"] = Parameter(
+        name="permeability",
+        vary=vary,
+        value=1.29e-10 if vary == Vary.FIXED else ValueMinMax(min=1e-11, max=1e-9),
+    )
+
+    create_dataset_and_datapoint_dirs(state)
+    state = preparation_stage(state)
+    state = variation_stage(state)
+    render_stage(state)
+
+    assert not (tmp_path / "render_test" / "fields").exists()
+    for datapoint in state.datapoints:
+        datapoint_dir = tmp_path / "render_test" / f"datapoint-{datapoint.index}"
+        assert not (datapoint_dir / "permeability_field.h5").exists()
+
+        pflotran_in = (datapoint_dir / "pflotran.in").read_text()
+        assert "DATASET perm" not in pflotran_in
+        assert f"PERM_ISO {datapoint.data['permeability'].value}\n" in pflotran_in
+
+
+def test_render_deduplicates_fields(tmp_path):
+    state = State()
+    state.general.interactive = False
+    state.general.output_directory = tmp_path / "render_test"
+    state.general.number_datapoints = 3
+    state.general.number_cells = np.array([16, 8, 2])
+    state.hydrogeological_parameters["permeability"] = Parameter(
+        name="permeability", vary=Vary.FIXED, value=np.full((16, 8, 2), 1.29e-10)
+    )
+
+    create_dataset_and_datapoint_dirs(state)
+    state = preparation_stage(state)
+    state = variation_stage(state)
+    render_stage(state)
+
+    files = [tmp_path / "render_test" / f"datapoint-{index}" / "permeability_field.h5" for index in range(3)]
+    # All data points link the same file
+    assert len({file.stat().st_ino for file in files}) == 1
+    assert len(list((tmp_path / "render_test" / "fields").glob("permeability_field-*.h5"))) == 1
+
+    for file in files:
+        with File(file) as h5file:
+            assert np.array_equal(h5file["Cell Ids"], np.arange(1, 16 * 8 * 2 + 1))
+            assert np.all(h5file["Permeability"][:] == 1.29e-10)
+
+
+def test_render_deduplicates_fields_without_hardlinks(tmp_path, monkeypatch):
+    def link(source, destination):
+        raise OSError("hardlinks are not supported")
+
+    monkeypatch.setattr(os, "link", link)
+
+    state = State()
+    state.general.interactive = False
+    state.general.output_directory = tmp_path / "render_test"
+    state.general.number_datapoints = 2
+    state.general.number_cells = np.array([16, 8, 2])
+    state.hydrogeological_parameters["permeability"] = Parameter(
+        name="permeability",
+        vary=Vary.SPACE,
+        distribution=Distribution.LOG,
+        value=ValuePerlin(frequency=[18, 18, 18], max=1e-9, min=1e-11),
+    )
+
+    create_dataset_and_datapoint_dirs(state)
+    state = preparation_stage(state)
+    state = variation_stage(state)
+    render_stage(state)
+
+    fields_dir = tmp_path / "render_test" / "fields"
+    assert len(list(fields_dir.glob("permeability_field-*.h5"))) == 2
+    assert len(list(fields_dir.glob("cell_ids-*.h5"))) == 1
+
+    for datapoint in state.datapoints:
+        with File(tmp_path / "render_test" / f"datapoint-{datapoint.index}" / "permeability_field.h5") as h5file:
+            assert np.array_equal(h5file["Cell Ids"], np.arange(1, 16 * 8 * 2 + 1))
+            assert np.array_equal(h5file["Permeability"], datapoint.data["permeability"].value.reshape(-1, order="F"))
+
+
+@pytest.mark.parametrize("shape", [(7, 5, 3), (16, 8, 2), (1, 9, 4)])
+@pytest.mark.parametrize("chunk_size", [1, 4, 7, 13, 64, 1000])
+@pytest.mark.parametrize("order", ["C", "F"])
+def test_fortran_order_chunks(shape, chunk_size, order):
+    cells = np.asarray(np.random.default_rng(0).random(shape), order=order)
+
+    chunks = list(fortran_order_chunks(cells, chunk_size))
+
+    assert [start for start, _ in chunks] == list(range(0, cells.size, chunk_size))
+    assert np.array_equal(np.concatenate([values for _, values in chunks]), cells.reshape(-1, order="F"))
+
+
+@pytest.mark.parametrize(
+    "compression, shuffle, chunk_size, chunks",
+    [
+        (Compression.NONE, False, None, None),
+        (Compression.NONE, False, 100, (100,)),
+        # The default chunk size is larger than the field
+        (Compression.GZIP, True, None, (16 * 8 * 2,)),
+        (Compression.LZF, False, 7, (7,)),
+    ],
+)
+def test_render_compressed_fields(tmp_path, compression, shuffle, chunk_size, chunks):
+    state = State()
+    state.general.interactive = False
+    state.general.output_directory = tmp_path / "render_test"
+    state.general.number_cells = np.array([16, 8, 2])
+    state.general.field_compression = compression
+    state.general.field_shuffle = shuffle
+    state.general.field_chunk_size = chunk_size
+    state.hydrogeological_parameters["permeability"] = Parameter(
+        name="permeability",
+        vary=Vary.SPACE,
+        distribution=Distribution.LOG,
+        value=ValuePerlin(frequency=[18, 18, 18], max=1e-9, min=1e-11),
+    )
+
+    create_dataset_and_datapoint_dirs(state)
+    state = preparation_stage(state)
+    state = variation_stage(state)
+    render_stage(state)
+
+    for datapoint in state.datapoints:
+        with File(tmp_path / "render_test" / f"datapoint-{datapoint.index}" / "permeability_field.h5") as h5file:
+            for dataset in [h5file["Cell Ids"], h5file["Permeability"]]:
+                assert dataset.compression == (None if compression == Compression.NONE else compression.value)
+                assert dataset.shuffle == shuffle
+                assert dataset.chunks == chunks
+            assert np.array_equal(h5file["Cell Ids"], np.arange(1, 16 * 8 * 2 + 1))
+            assert np.array_equal(h5file["Permeability"], datapoint.data["permeability"].value.reshape(-1, order="F"))
+
+
+def test_render_incremental(tmp_path):
+    def render(temperature, incremental_render=True, **settings):
+        state = State()
+        state.general.interactive = False
+        state.general.output_directory = tmp_path / "render_test"
+        state.general.number_datapoints = 2
+        state.general.number_cells = np.array([16, 8, 2])
+        state.general.incremental_render = incremental_render
+        for name, value in settings.items():
+            setattr(state.general, name, value)
+        state.hydrogeological_parameters["permeability"] = Parameter(
+            name="permeability",
+            vary=Vary.SPACE,
+            distribution=Distribution.LOG,
+            value=ValuePerlin(frequency=[18, 18, 18], max=1e-9, min=1e-11),
+        )
+        state.hydrogeological_parameters["temperature"] = Parameter(
+            name="temperature", vary=Vary.CONST, value=ValueMinMax(min=10, max=temperature)
+        )
+
+        create_dataset_and_datapoint_dirs(state)
+        state = preparation_stage(state)
+        state = variation_stage(state)
+        render_stage(state)
+
+    def reset_timestamps():
+        files = [path for path in (tmp_path / "render_test").rglob("*") if path.is_file()]
+        for file in files:
+            os.utime(file, ns=(0, 0))
+        return files
+
+    def rewritten(files):
+        return {file.relative_to(tmp_path / "render_test").as_posix() for file in files if file.stat().st_mtime_ns != 0}
+
+    render(12)
+    files = reset_timestamps()
+
+    # Nothing changed, so nothing is written again
+    render(12)
+    assert rewritten(files) == set()
+
+    # Settings of the later stages don't change the rendered files
+    render(12, simulation_jobs=4, simulation_timeout=60, simulation_retries=3, mpirun_procs=2, skip_visualization=True)
+    assert rewritten(files) == set()
+
+    # Only the temperature of the second data point changes
+    render(14)
+    assert rewritten(files) == {
+        "datapoint-1/datapoint.json",
+        "datapoint-1/pflotran.in",
+        "datapoint-1/render.fingerprint",
+    }
+
+    # Missing files are rendered again
+    files = reset_timestamps()
+    (tmp_path / "render_test" / "datapoint-0" / "pflotran.in").unlink()
+    render(14)
+    assert rewritten(files) == {"datapoint-0/pflotran.in", "datapoint-0/render.fingerprint"}
+
+    files = reset_timestamps()
+    render(14, incremental_render=False)
+    assert {"mesh.uge", "datapoint-0/pflotran.in", "datapoint-1/pflotran.in"} <= rewritten(files)
@@ -1,36 +1,319 @@
+import json
+import logging
+import os
 import subprocess
-from unittest.mock import patch
+import time
+import weakref
+from argparse import Namespace
+from pathlib import Path
+from unittest.mock import ANY, patch
 
-from vampireman import preparation_stage, simulation_stage
-from vampireman.data_structures import State
+import pytest
 
+from vampireman import loading_stage, preparation_stage, simulation_stage
+from vampireman.data_structures import DataPoint, State
+from vampireman.pflotran.simulation_stage import (
+    SimulationResult,
+    format_duration,
+    mpirun_is_open_mpi,
+    simulate_datapoints,
+    simulation_jobs,
+)
+from vampireman.pipeline import exit_if_simulations_failed
+from vampireman.utils import create_dataset_and_datapoint_dirs
 
-def mock_pflotran_call(*args, **kwargs):
-    return subprocess.CompletedProcess(args=args, returncode=0, stdout="Done", stderr="")
 
+class MockProcess:
+    pid = -1
+    returncode = 0
 
-@patch("subprocess.run", side_effect=mock_pflotran_call)
-def test_simulation(mock_run):
+    async def wait(self):
+        return self.returncode
+
+
+async def mock_pflotran_call(*args, **kwargs):
+    return MockProcess()
+
+
+@patch("asyncio.create_subprocess_exec", side_effect=mock_pflotran_call)
+def test_simulation(mock_run, tmp_path):
     state = State()
     state.general.interactive = False
+    state.general.output_directory = tmp_path / "simulation_test"
+    state.general.simulation_jobs = 1
 
     state.general.number_datapoints = 5
     state.general.mpirun = True
     state.general.mpirun_procs = 1
     state.general.mute_simulation_output = False
     state = preparation_stage(state)
+    create_dataset_and_datapoint_dirs(state)
     simulation_stage(state)
     assert mock_run.call_count == 5
-    mock_run.assert_called_with(["mpirun", "-n", "1", "--", "pflotran"], check=True, close_fds=True)
+    mock_run.assert_called_with(
+        *["mpirun", "-n", "1", "--", "pflotran"],
+        cwd=tmp_path / "simulation_test" / "datapoint-4",
+        stdin=subprocess.DEVNULL,
+        stdout=ANY,
+        stderr=subprocess.STDOUT,
+        start_new_session=True,
+    )
 
     state.general.mpirun = False
     state = preparation_stage(state)
     simulation_stage(state)
-    mock_run.assert_called_with(["pflotran"], check=True, close_fds=True)
+    mock_run.assert_called_with(
+        *["pflotran"],
+        cwd=tmp_path / "simulation_test" / "datapoint-4",
+        stdin=subprocess.DEVNULL,
+        stdout=ANY,
+        stderr=subprocess.STDOUT,
+        start_new_session=True,
+    )
 
     state.general.mpirun = True
     state.general.mpirun_procs = None
     state.general.mute_simulation_output = True
     state = preparation_stage(state)
     simulation_stage(state)
-    mock_run.assert_called_with(["mpirun", "--", "pflotran", "-screen_output", "off"], check=True, close_fds=True)
+    mock_run.assert_called_with(
+        *["mpirun", "--", "pflotran", "-screen_output", "off"],
+        cwd=tmp_path / "simulation_test" / "datapoint-4",
+        stdin=subprocess.DEVNULL,
+        stdout=ANY,
+        stderr=subprocess.STDOUT,
+        start_new_session=True,
+    )
+
+    # Concurrent simulations must not be bound to the same cores
+    state.general.mpirun_procs = 1
+    state.general.mute_simulation_output = False
+    state.general.simulation_jobs = 2
+    with patch("vampireman.pflotran.simulation_stage.mpirun_is_open_mpi", return_value=True):
+        simulation_stage(state)
+    assert list(mock_run.call_args.args) == ["mpirun", "-n", "1", "--bind-to", "none", "--", "pflotran"]
+
+    # Other MPI implementations don't know the option of Open MPI
+    with patch("vampireman.pflotran.simulation_stage.mpirun_is_open_mpi", return_value=False):
+        simulation_stage(state)
+    assert list(mock_run.call_args.args) == ["mpirun", "-n", "1", "--", "pflotran"]
+
+
+FAKE_PFLOTRAN = """#!/bin/sh
+# Records how many simulations run at the same time
+touch "{running}/$$"
+ls "{running}" | wc -l >> "{running}/../concurrency"
+echo "Simulating in $(pwd)"
+sleep 0.3
+rm "{running}/$$"
+case "$(pwd)" in
+    *datapoint-{failing}) exit 1 ;;
+    *datapoint-{hanging}) sleep 60 & echo $! > ../hanging.pid; wait ;;
+    *datapoint-{crashing}) if [ ! -e crashed ]; then touch crashed; kill -9 $$; fi ;;
+esac
+touch pflotran.out pflotran.h5
+"""
+
+
+def make_state(tmp_path, monkeypatch, jobs, failing=-1, hanging=-1, crashing=-1):
+    running = tmp_path / "running"
+    running.mkdir()
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    pflotran = bin_dir / "pflotran"
+    pflotran.write_text(FAKE_PFLOTRAN.format(running=running, failing=failing, hanging=hanging, crashing=crashing))
+    pflotran.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    state = State()
+    state.general.interactive = False
+    state.general.mpirun = False
+    state.general.output_directory = tmp_path / "simulation_test"
+    state.general.number_datapoints = 4
+    state.general.simulation_jobs = jobs
+    create_dataset_and_datapoint_dirs(state)
+    return state
+
+
+def is_running(pid):
+    try:
+        status = Path(f"/proc/{pid}/status").read_text()
+    except FileNotFoundError:
+        return False
+    # Killed processes may linger as zombies until they are reaped
+    return "State:\tZ" not in status
+
+
+def max_concurrency(tmp_path):
+    return max(int(line) for line in (tmp_path / "concurrency").read_text().split())
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_simulation_stage_runs_jobs_at_once(tmp_path, monkeypatch, jobs):
+    state = make_state(tmp_path, monkeypatch, jobs)
+    original_dir = os.getcwd()
+
+    simulation_stage(state)
+
+    assert os.getcwd() == original_dir
+    assert max_concurrency(tmp_path) == jobs
+    for index in range(4):
+        datapoint_path = tmp_path / "simulation_test" / f"datapoint-{index}"
+        assert (datapoint_path / "pflotran.h5").exists()
+        assert (datapoint_path / "simulation.log").read_text() == f"Simulating in {datapoint_path}\n"
+
+
+def test_simulation_stage_fails(tmp_path, monkeypatch):
+    state = make_state(tmp_path, monkeypatch, 2, failing=1)
+
+    simulation_stage(state)
+
+    # The other simulations still ran
+    for index in [0, 2, 3]:
+        assert (tmp_path / "simulation_test" / f"datapoint-{index}" / "pflotran.h5").exists()
+    assert not (tmp_path / "simulation_test" / "datapoint-1" / "pflotran.h5").exists()
+
+    # Failures that aren't transient are not retried
+    failures = json.loads((tmp_path / "simulation_test" / "failed_simulations.json").read_text())
+    assert failures == [
+        {
+            "index": 1,
+            "exit_code": 1,
+            "timed_out": False,
+            "attempts": 1,
+            "log_file": str(tmp_path / "simulation_test" / "datapoint-1" / "simulation.log"),
+        }
+    ]
+
+    with pytest.raises(SystemExit) as exit_info:
+        exit_if_simulations_failed(state)
+    assert exit_info.value.code == 1
+
+    # The manifest is removed once all simulations succeeded
+    (tmp_path / "again").mkdir()
+    state = make_state(tmp_path / "again", monkeypatch, 2)
+    state.general.output_directory = tmp_path / "simulation_test"
+    simulation_stage(state)
+    assert (tmp_path / "simulation_test" / "datapoint-1" / "pflotran.h5").exists()
+    assert not (tmp_path / "simulation_test" / "failed_simulations.json").exists()
+    exit_if_simulations_failed(state)
+
+
+def test_simulation_stage_timeout(tmp_path, monkeypatch):
+    state = make_state(tmp_path, monkeypatch, 2, hanging=2)
+    state.general.simulation_timeout = 1
+    state.general.simulation_retries = 1
+
+    start_time = time.monotonic()
+    simulation_stage(state)
+
+    assert time.monotonic() - start_time < 10
+    failures = json.loads((tmp_path / "simulation_test" / "failed_simulations.json").read_text())
+    assert [(failure["index"], failure["timed_out"], failure["attempts"]) for failure in failures] == [(2, True, 2)]
+    assert (tmp_path / "simulation_test" / "datapoint-2" / "simulation.log").read_text().count("Simulating in") == 2
+
+    # The children of the simulation were terminated as well
+    assert not is_running(int((tmp_path / "simulation_test" / "hanging.pid").read_text()))
+
+
+def test_simulation_stage_retries(tmp_path, monkeypatch, caplog):
+    state = make_state(tmp_path, monkeypatch, 2, crashing=3)
+
+    with caplog.at_level(logging.INFO):
+        simulation_stage(state)
+
+    assert (tmp_path / "simulation_test" / "datapoint-3" / "pflotran.h5").exists()
+    assert not (tmp_path / "simulation_test" / "failed_simulations.json").exists()
+    assert "=== Attempt 2 ===" in (tmp_path / "simulation_test" / "datapoint-3" / "simulation.log").read_text()
+    assert "Simulated 4 of 4 datapoints (0 failed)" in caplog.text
+    assert "datapoints/hour" in caplog.text
+
+
+@pytest.mark.parametrize(
+    "exit_code, timed_out, transient",
+    [
+        (1, False, False),
+        (134, False, False),  # mpirun reporting SIGABRT
+        (-6, False, False),
+        (137, False, True),  # mpirun reporting SIGKILL
+        (-9, False, True),
+        (-15, True, True),
+    ],
+)
+def test_simulation_result_transient(exit_code, timed_out, transient):
+    assert SimulationResult(index=0, exit_code=exit_code, timed_out=timed_out).transient == transient
+
+
+def test_format_duration():
+    assert format_duration(0) == "0:00:00"
+    assert format_duration(3725.4) == "1:02:05"
+
+
+def test_simulate_datapoints(tmp_path, monkeypatch):
+    state = make_state(tmp_path, monkeypatch, 3)
+    datapoints = [DataPoint(index=index, data={}) for index in range(4)]
+
+    simulated = list(simulate_datapoints(state, iter(datapoints)))
+
+    assert sorted(datapoint.index for datapoint in simulated) == [0, 1, 2, 3]
+    assert max_concurrency(tmp_path) == 3
+
+
+def test_simulate_datapoints_releases_failed(tmp_path, monkeypatch):
+    state = make_state(tmp_path, monkeypatch, 1, failing=1)
+    references = []
+
+    def datapoints():
+        for index in range(4):
+            datapoint = DataPoint(index=index, data={})
+            references.append(weakref.ref(datapoint))
+            yield datapoint
+
+    simulated = simulate_datapoints(state, datapoints())
+    assert next(simulated).index == 0
+    # The failed data point is dropped before the next one is yielded
+    assert next(simulated).index == 2
+    assert references[1]() is None
+    assert [datapoint.index for datapoint in simulated] == [3]
+
+
+def test_mpirun_is_open_mpi(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    mpirun = bin_dir / "mpirun"
+    mpirun.write_text("#!/bin/sh\necho 'HYDRA build details:'\n")
+    mpirun.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    mpirun_is_open_mpi.cache_clear()
+    assert not mpirun_is_open_mpi()
+
+    mpirun.write_text("#!/bin/sh\necho 'mpirun (Open MPI) 4.1.4'\n")
+    mpirun_is_open_mpi.cache_clear()
+    assert mpirun_is_open_mpi()
+
+    monkeypatch.setenv("PATH", str(tmp_path / "missing"))
+    mpirun_is_open_mpi.cache_clear()
+    assert not mpirun_is_open_mpi()
+    mpirun_is_open_mpi.cache_clear()
+
+
+def test_simulation_jobs(monkeypatch):
+    monkeypatch.setattr(os, "sched_getaffinity", lambda pid: set(range(128)), raising=False)
+    state = State()
+
+    assert simulation_jobs(state) == 128
+    state.general.mpirun_procs = 6
+    assert simulation_jobs(state) == 21
+    state.general.mpirun_procs = None
+    assert simulation_jobs(state) == 1
+    state.general.mpirun = False
+    assert simulation_jobs(state) == 128
+    state.general.simulation_jobs = 3
+    assert simulation_jobs(state) == 3
+
+
+def test_simulation_jobs_from_command_line():
+    state = loading_stage(Namespace(settings_file=None, sim_tool="pflotran", non_interactive=True, jobs=5))
+
+    assert state.general.simulation_jobs == 5
@@ -1,17 +1,27 @@
+import logging
+
+import noise
 import numpy as np
+import pytest
 
 from vampireman import preparation_stage, variation_stage
 from vampireman.data_structures import (
     Distribution,
     HeatPump,
+    HeatPumps,
     Parameter,
+    Sampling,
     State,
+    ValueGaussianField,
     ValueMinMax,
     ValuePerlin,
     ValueTimeSeries,
     Vary,
 )
 from vampireman.utils import create_dataset_and_datapoint_dirs
+from vampireman.variation_stage import perlin_cache
+from vampireman.variation_stage.vary import generate_heatpump_locations
+from vampireman.variation_stage.vary_perlin import calc_pressure_from_gradient_field, create_perlin_field, pnoise3
 
 
 def test_vary_copy():
@@ -90,6 +100,219 @@ def test_vary_space():
     assert not np.array_equal(data_perlin_0.value, data_perlin_1.value)
 
 
+def test_vary_space_in_parallel():
+    def vary(number_workers):
+        state = State()
+        state.general.interactive = False
+        state.general.number_datapoints = 4
+        state.general.number_cells = np.array([16, 8, 2])
+        state.general.number_workers = number_workers
+
+        create_dataset_and_datapoint_dirs(state)
+
+        state.hydrogeological_parameters["permeability"] = Parameter(
+            name="permeability",
+            vary=Vary.SPACE,
+            distribution=Distribution.LOG,
+            value=ValuePerlin(frequency=ValueMinMax(min=2, max=4), max=1e-9, min=1e-11),
+        )
+        state.hydrogeological_parameters["pressure_gradient"] = Parameter(
+            name="pressure_gradient",
+            vary=Vary.SPACE,
+            value=ValuePerlin(frequency=[18, 18, 18], max=-0.002, min=-0.003),
+        )
+        state.heatpump_parameters["hp1"].vary = Vary.SPACE
+
+        state = preparation_stage(state)
+        return variation_stage(state).datapoints
+
+    serial = vary(1)
+    parallel = vary(2)
+
+    for serial_datapoint, parallel_datapoint in zip(serial, parallel, strict=True):
+        assert list(serial_datapoint.data) == list(parallel_datapoint.data)
+        for name, data in serial_datapoint.data.items():
+            if isinstance(data.value, np.ndarray):
+                assert np.array_equal(data.value, parallel_datapoint.data[name].value)
+            else:
+                assert data.value == parallel_datapoint.data[name].value
+
+
+@pytest.mark.parametrize("number_workers", [1, 2])
+def test_datapoint_random_streams(number_workers):
+    def vary(number_datapoints):
+        state = State()
+        state.general.interactive = False
+        state.general.number_datapoints = number_datapoints
+        state.general.number_cells = np.array([16, 8, 2])
+        state.general.number_workers = number_workers
+        state.general.shuffle_datapoints = False
+        state.general.datapoint_random_streams = True
+
+        create_dataset_and_datapoint_dirs(state)
+
+        state.hydrogeological_parameters["permeability"] = Parameter(
+            name="permeability",
+            vary=Vary.SPACE,
+            distribution=Distribution.LOG,
+            value=ValuePerlin(frequency=ValueMinMax(min=2, max=4), max=1e-9, min=1e-11),
+        )
+        state.heatpump_parameters["hp1"].vary = Vary.SPACE
+        state.heatpump_parameters["hp1"].value.injection_temp = ValueMinMax(min=12, max=16)
+
+        state = preparation_stage(state)
+        # Drawing from the shared generator does not change the streams of the data points
+        state.get_rng().random(number_datapoints)
+        return variation_stage(state).datapoints
+
+    few = vary(3)
+    many = vary(5)
+
+    # A data point doesn't depend on how many other data points are generated
+    for few_datapoint, many_datapoint in zip(few, many[:3], strict=True):
+        assert np.array_equal(few_datapoint.data["permeability"].value, many_datapoint.data["permeability"].value)
+        assert few_datapoint.data["hp1"].value == many_datapoint.data["hp1"].value
+
+    assert not np.array_equal(many[0].data["permeability"].value, many[1].data["permeability"].value)
+
+
+def test_perlin_field_in_chunks():
+    parameter = Parameter(
+        name="permeability",
+        vary=Vary.SPACE,
+        distribution=Distribution.LOG,
+        value=ValuePerlin(frequency=[18, 18, 18], max=1e-9, min=1e-11),
+    )
+
+    def field(perlin_chunk_size):
+        state = State()
+        state.general.number_cells = np.array([17, 8, 3])
+        state.general.perlin_chunk_size = perlin_chunk_size
+        return create_perlin_field(state, parameter)
+
+    in_memory = field(None)
+    # Chunks that do not divide the grid and chunks smaller than a single row
+    for perlin_chunk_size in [50, 1]:
+        in_chunks = field(perlin_chunk_size)
+        assert isinstance(in_chunks, np.memmap)
+        assert np.array_equal(in_chunks, in_memory)
+
+
+def test_pressure_from_gradient_field():
+    state = State()
+    parameter = Parameter(
+        name="pressure_gradient",
+        vary=Vary.SPACE,
+        value=ValuePerlin(frequency=[18, 18, 18], max=-0.002, min=-0.003),
+    )
+    gradient_field = np.random.default_rng(0).random((6, 10, 3))
+
+    # The previous implementation, integrating column by column
+    current_min = np.min(gradient_field)
+    current_max = np.max(gradient_field)
+    scaled = (gradient_field - current_min) / (current_max - current_min) * (-0.002 - -0.003) + -0.003
+    expected = np.zeros(gradient_field.shape)
+    expected[:, 0] = 101325
+    for i in range(1, expected.shape[1]):
+        expected[:, i] = expected[:, i - 1] + scaled[:, i] * state.general.cell_resolution * 1000
+
+    pressure_field = calc_pressure_from_gradient_field(gradient_field.copy(), state, parameter)
+
+    # The same operations in the same order give bit-identical results
+    assert np.array_equal(pressure_field, expected[::-1])
+
+
+@pytest.mark.parametrize("number_workers", [1, 2])
+def test_perlin_field_cache(tmp_path, caplog, number_workers):
+    def vary(perlin_cache_size=2**20, random_seed=0):
+        state = State(general={"random_seed": random_seed})
+        state.general.interactive = False
+        state.general.number_datapoints = 3
+        state.general.number_cells = np.array([16, 8, 2])
+        state.general.number_workers = number_workers
+        state.general.output_directory = tmp_path / "output"
+        state.general.perlin_cache_directory = tmp_path / "cache"
+        state.general.perlin_cache_size = perlin_cache_size
+
+        create_dataset_and_datapoint_dirs(state)
+
+        state.hydrogeological_parameters["permeability"] = Parameter(
+            name="permeability",
+            vary=Vary.SPACE,
+            distribution=Distribution.LOG,
+            value=ValuePerlin(frequency=ValueMinMax(min=2, max=4), max=1e-9, min=1e-11),
+        )
+
+        state = preparation_stage(state)
+        return [datapoint.data["permeability"].value for datapoint in variation_stage(state).datapoints]
+
+    with caplog.at_level(logging.INFO):
+        computed = vary()
+    assert "Perlin field cache in variation stage: 0 hits, 3 misses" in caplog.messages
+    assert perlin_cache.statistics == {}
+    assert len(list((tmp_path / "cache").iterdir())) == 3
+
+    caplog.clear()
+    with caplog.at_level(logging.INFO):
+        loaded = vary()
+    assert "Perlin field cache in variation stage: 3 hits, 0 misses" in caplog.messages
+    for computed_field, loaded_field in zip(computed, loaded, strict=True):
+        assert isinstance(loaded_field, np.memmap)
+        assert np.array_equal(computed_field, loaded_field)
+
+    # Only the most recently used field fits into the cache
+    vary(perlin_cache_size=computed[0].nbytes + 1000, random_seed=1)
+    assert perlin_cache.statistics == {}
+    assert len(list((tmp_path / "cache").iterdir())) == 1
+
+
+def test_pnoise3_matches_noise():
+    points = (np.random.default_rng(0).random((3, 10000)) - 0.25) * [[1], [100], [90000]]
+
+    expected = np.array([noise.pnoise3(x, y, z) for x, y, z in points.T])
+
+    assert np.array_equal(pnoise3(*points), expected)
+
+    # Coordinates are broadcast against each other
+    x, y, z = np.ix_(points[0, :7], points[1, :5], points[2, :3])
+    expected = np.array([noise.pnoise3(*point) for point in np.stack(np.broadcast_arrays(x, y, z), -1).reshape(-1, 3)])
+
+    assert np.array_equal(pnoise3(x, y, z).flatten(), expected)
+
+
+def test_vary_gaussian_field():
+    state = State()
+    state.general.interactive = False
+    state.general.number_datapoints = 2
+    state.general.number_cells = np.array([64, 64, 4])
+
+    create_dataset_and_datapoint_dirs(state)
+
+    state.hydrogeological_parameters["permeability"] = Parameter(
+        name="permeability",
+        vary=Vary.SPACE,
+        distribution=Distribution.LOG,
+        value=ValueGaussianField(correlation_length=[20, 20, 5], mean=1e-10, variance=0.25),
+    )
+
+    state = preparation_stage(state)
+    state = variation_stage(state)
+
+    field_0 = state.datapoints[0].data["permeability"].value
+    field_1 = state.datapoints[1].data["permeability"].value
+
+    assert field_0.shape == (64, 64, 4)
+    assert not np.array_equal(field_0, field_1)
+
+    # The logarithm of the field is normally distributed with the given mean and variance
+    log_fields = np.log10([field_0, field_1])
+    assert abs(log_fields.mean() + 10) < 0.2
+    assert abs(log_fields.var() - 0.25) < 0.1
+
+    # Neighbouring cells are correlated
+    assert np.corrcoef(log_fields[..., :-1, :].ravel(), log_fields[..., 1:, :].ravel())[0, 1] > 0.9
+
+
 def test_vary_heatpump():
     state = State()
     state.general.interactive = False
@@ -118,6 +341,54 @@ def test_vary_heatpump():
     assert hp_data_0.value.location != hp_data_1.value.location
 
 
+@pytest.mark.parametrize("number_workers", [1, 2])
+def test_vary_heatpump_locations_dont_clash(number_workers):
+    state = State()
+    state.general.interactive = False
+    state.general.number_datapoints = 20
+    state.general.number_workers = number_workers
+    state.general.cell_resolution = 1.0
+    state.general.number_cells = np.array([2, 2, 1])
+
+    create_dataset_and_datapoint_dirs(state)
+
+    state.heatpump_parameters = {
+        "fixed": Parameter(
+            name="fixed",
+            vary=Vary.FIXED,
+            value=HeatPump(location=[1, 2, 1], injection_temp=13.6, injection_rate=0.00024),
+        ),
+        "hps": Parameter(
+            name="hps",
+            vary=Vary.SPACE,
+            value=HeatPumps(number=3, injection_temp=13.6, injection_rate=0.00024),
+        ),
+    }
+
+    state = preparation_stage(state)
+    state = variation_stage(state)
+
+    # The spatially varied heat pumps have to share the three remaining cells
+    for datapoint in state.datapoints:
+        locations = [tuple(data.value.location) for data in datapoint.data.values() if isinstance(data.value, HeatPump)]
+        assert sorted(locations) == [(0.5, 0.5, 0.5), (0.5, 1.5, 0.5), (1.5, 0.5, 0.5), (1.5, 1.5, 0.5)]
+
+
+def test_generate_heatpump_locations_one_by_one():
+    state = State()
+    state.general.number_cells = np.array([10, 10, 1])
+    occupied_cells = set(range(0, 100, 3))
+
+    locations = [generate_heatpump_locations(state, 1, occupied_cells)[0] for _ in range(16)]
+
+    cells = {
+        int(np.ravel_multi_index(tuple(int(index) - 1 for index in location), (10, 10, 1))) for location in locations
+    }
+    assert len(cells) == 16
+    assert cells.isdisjoint(range(0, 100, 3))
+    assert len(occupied_cells) == 34 + 16
+
+
 def test_vary_const():
     # TODO: Write CONST&&ValueMinMaxArray test
     state = State()
@@ -162,6 +433,50 @@ def test_vary_const():
     assert data_2.value == 0.32
 
 
+@pytest.mark.parametrize("sampling", [Sampling.SOBOL, Sampling.LATIN_HYPERCUBE])
+def test_vary_const_sampling(sampling):
+    def vary(shuffle_datapoints):
+        state = State()
+        state.general.interactive = False
+        state.general.shuffle_datapoints = shuffle_datapoints
+        state.general.number_datapoints = 16
+        state.general.const_sampling = sampling
+
+        create_dataset_and_datapoint_dirs(state)
+
+        state.hydrogeological_parameters["parameter"] = Parameter(
+            name="parameter",
+            vary=Vary.CONST,
+            value=ValueMinMax(min=1, max=5),
+        )
+        state.hydrogeological_parameters["parameter2"] = Parameter(
+            name="parameter2",
+            vary=Vary.CONST,
+            distribution=Distribution.LOG,
+            value=ValueMinMax(min=1e-12, max=1e-8),
+        )
+
+        state = preparation_stage(state)
+        state = variation_stage(state)
+        return [
+            (datapoint.data["parameter"].value, datapoint.data["parameter2"].value) for datapoint in state.datapoints
+        ]
+
+    values = vary(shuffle_datapoints=False)
+    first, second = np.array(values).T
+
+    assert np.all((first >= 1) & (first <= 5))
+    assert np.all((second >= 1e-12) & (second <= 1e-8))
+
+    # Both designs have exactly one point in each of the 16 intervals of each parameter
+    assert np.array_equal(np.sort(np.floor((first - 1) / 4 * 16)), np.arange(16))
+    assert np.array_equal(np.sort(np.floor((np.log10(second) + 12) / 4 * 16)), np.arange(16))
+
+    # Shuffling keeps the points of the design together and it is reproducible
+    assert sorted(vary(shuffle_datapoints=True)) == sorted(values)
+    assert vary(shuffle_datapoints=False) == values
+
+
 def test_shuffle():
     state = State()
     state.general.interactive = False
@@ -157,6 +157,7 @@ def write_data_to_verified_json_file(state: "State", target_path: Path, data: Ba
                 need_to_write_file = False
         else:
             logging.debug("File '%s' doesn't need to be written", target_path)
+            need_to_write_file = False
 
     if need_to_write_file:
         with open(target_path, "w", encoding="utf8") as target_file:
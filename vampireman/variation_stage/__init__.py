@@ -1 +1,2 @@
 from .variation_stage import variation_stage as variation_stage
+from .variation_stage import vary_datapoints as vary_datapoints
@@ -0,0 +1,126 @@
+"""
+An on-disk cache for perlin fields, see `vampireman.data_structures.GeneralConfig.perlin_cache_directory`.
+
+A perlin field is fully determined by the grid, its random offset and frequencies and the `Parameter` it is computed
+for, so a field that was computed once can be loaded from the cache instead of being computed again.
+Fields are stored as `.npy` files named after the hash of these values.
+The modification time of a file is updated whenever it is loaded, so when the cache grows larger than
+`vampireman.data_structures.GeneralConfig.perlin_cache_size`, the least recently used fields are removed.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from collections import Counter
+from pathlib import Path
+from typing import Any, cast
+
+import numpy as np
+from numpy.typing import NDArray
+
+from ..data_structures import Parameter, State, ValuePerlin
+
+statistics: Counter[str] = Counter()
+"""
+The number of cache `hits` and `misses` since the last `log_statistics()`.
+"""
+
+
+def perlin_field_cache_key(
+    state: State, parameter: Parameter, base_offset: NDArray[np.floating[Any]], freq_factor: list[float]
+) -> str:
+    """
+    Returns the hash a perlin field is cached under.
+    """
+
+    assert isinstance(parameter.value, ValuePerlin)
+
+    key = {
+        "number_cells": [int(n) for n in cast(np.ndarray, state.general.number_cells)],
+        "offset": [float(offset) for offset in base_offset],
+        "frequency": [float(frequency) for frequency in freq_factor],
+        "min": parameter.value.min,
+        "max": parameter.value.max,
+        "distribution": parameter.distribution,
+        "precision": state.general.precision,
+        # A pressure gradient field is integrated to a pressure field, which also depends on the cell size
+        "pressure_resolution": state.general.cell_resolution if parameter.name == "pressure_gradient" else None,
+    }
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+
+def load_perlin_field(state: State, key: str) -> None | NDArray[np.floating[Any]]:
+    """
+    Load the perlin field cached under `key`, or return `None` if it is not cached.
+    The field is memory-mapped copy-on-write, so it is only read from disk when it is used and modifying it does not
+    modify the cache.
+    """
+
+    cache_dir = cast(Path, state.general.perlin_cache_directory)
+    path = cache_dir / f"{key}.npy"
+
+    try:
+        field = np.load(path, mmap_mode="c")
+        # Mark the field as recently used
+        os.utime(path)
+    except FileNotFoundError:
+        statistics["misses"] += 1
+        return None
+
+    statistics["hits"] += 1
+    return field
+
+
+def store_perlin_field(state: State, key: str, field: NDArray[np.floating[Any]]) -> None:
+    """
+    Store a perlin field in the cache under `key`.
+    Afterwards, the least recently used fields are removed until the cache fits into
+    `vampireman.data_structures.GeneralConfig.perlin_cache_size` again.
+    """
+
+    cache_dir = cast(Path, state.general.perlin_cache_directory)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Write to a temporary file first, so an aborted run or a concurrent run never leaves a half written field in the
+    # cache
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=cache_dir, prefix=f".{key}-", suffix=".npy")
+    with os.fdopen(file_descriptor, "wb") as file:
+        np.save(file, field)
+    os.replace(temporary_path, cache_dir / f"{key}.npy")
+
+    evict_perlin_fields(cache_dir, state.general.perlin_cache_size)
+
+
+def evict_perlin_fields(cache_dir: Path, cache_size: int) -> None:
+    """
+    Remove the least recently used fields from the `cache_dir` until the remaining fields take up at most `cache_size`
+    bytes.
+    """
+
+    fields = []
+    for path in cache_dir.glob("[!.]*.npy"):
+        try:
+            fields.append((path.stat(), path))
+        except FileNotFoundError:
+            # Removed by a concurrent run
+            continue
+
+    fields.sort(key=lambda field: field[0].st_mtime, reverse=True)
+
+    used_size = 0
+    for stat, path in fields:
+        used_size += stat.st_size
+        if used_size > cache_size:
+            logging.debug("Removing perlin field %s from the cache", path)
+            path.unlink(missing_ok=True)
+
+
+def log_statistics(stage: str) -> None:
+    """
+    Log the number of cache hits and misses during the given `stage` and reset them.
+    """
+
+    logging.info("Perlin field cache in %s: %s hits, %s misses", stage, statistics["hits"], statistics["misses"])
+    statistics.clear()
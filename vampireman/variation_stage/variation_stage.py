@@ -5,9 +5,12 @@ The variation stage takes care of varying all `vampireman.data_structures.Parame
 The decision how to vary parameters is implemented in `vampireman.variation_stage.vary.vary_parameter()`.
 """
 
-from ..data_structures import State
+from collections.abc import Iterator
+
+from ..data_structures import DataPoint, State
 from ..utils import profile_function, write_data_to_verified_json_file
-from .vary import vary_params
+from . import perlin_cache
+from .vary import generate_datapoints, vary_params
 
 
 @profile_function
@@ -17,6 +20,8 @@ def variation_stage(state: State) -> State:
     """
 
     state = vary_params(state)
+    if state.general.perlin_cache_directory is not None:
+        perlin_cache.log_statistics("variation stage")
     print("Following datapoints will be used")
     for datapoint in state.datapoints:
         print(datapoint)
@@ -24,3 +29,22 @@ def variation_stage(state: State) -> State:
             state, state.general.output_directory / f"datapoint-{datapoint.index}" / "datapoint.json", datapoint
         )
     return state
+
+
+def vary_datapoints(state: State) -> Iterator[DataPoint]:
+    """
+    Runs the stage for one `vampireman.data_structures.DataPoint` after the other, yielding each of them once it is
+    varied, see `vampireman.pipeline.run_streaming`.
+    The spatially varied fields of a data point are only computed when it is yielded, and the data points are not
+    added to `vampireman.data_structures.State.datapoints`.
+    """
+
+    for datapoint in generate_datapoints(state, defer_fields=True):
+        print(datapoint)
+        write_data_to_verified_json_file(
+            state, state.general.output_directory / f"datapoint-{datapoint.index}" / "datapoint.json", datapoint
+        )
+        yield datapoint
+
+    if state.general.perlin_cache_directory is not None:
+        perlin_cache.log_statistics("variation stage")
@@ -1,9 +1,14 @@
 import logging
+import warnings
+from collections.abc import Callable, Collection, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
 from copy import deepcopy
+from functools import partial
 from typing import cast
 
 import numpy as np
-from numpy.typing import ArrayLike
+from numpy.typing import NDArray
+from scipy.stats import qmc
 
 from ..data_structures import (
     Data,
@@ -12,39 +17,83 @@ from ..data_structures import (
     HeatPump,
     HeatPumps,
     Parameter,
+    Sampling,
     State,
+    ValueGaussianField,
     ValueMinMax,
     ValuePerlin,
     ValueTimeSeries,
     Vary,
 )
-from .vary_perlin import create_perlin_field
+from .perlin_cache import load_perlin_field, perlin_field_cache_key, store_perlin_field
+from .vary_gaussian import compute_gaussian_field, create_gaussian_field, draw_gaussian_seed
+from .vary_perlin import (
+    compute_perlin_field,
+    create_perlin_field,
+    draw_perlin_offset_and_frequency,
+    load_or_compute_perlin_field,
+)
+
+DeferredField = Callable[[], NDArray]
+"""
+A function that computes a spatially varied field from random values that were drawn before, see `draw_field()`.
+"""
 
 
 def copy_parameter(state: State, parameter: Parameter) -> Data:
     """
     This function simply copies all values from a `Parameter` to a `Data` object without any transformation.
+
+    Arrays, e.g. a permeability field read in by `vampireman.preparation_stage.preparation_stage.read_in_files`, are
+    not copied but shared by all data points as a read-only view, so they only take up memory once.
+    Stages that need to modify such a value have to copy it first.
     """
 
     if isinstance(parameter.value, HeatPump):
         return vary_heatpump(state, parameter)
+    if isinstance(parameter.value, np.ndarray):
+        return Data(name=parameter.name, value=read_only_view(parameter.value))
     return Data(name=parameter.name, value=deepcopy(parameter.value))
 
 
-def vary_heatpump(state: State, parameter: Parameter) -> Data:
+def read_only_view(array: NDArray) -> NDArray:
+    """
+    Returns a view of the `array` that can not be written to, the `array` itself stays writable.
+    """
+
+    view = array.view()
+    view.flags.writeable = False
+    return view
+
+
+def vary_heatpump(
+    state: State,
+    parameter: Parameter,
+    occupied_cells: None | set[int] = None,
+    rng: None | np.random.Generator = None,
+) -> Data:
     """
     This function calculates operational parameters for `vampireman.data_structures.HeatPump`s.
-    If the `vampireman.data_structures.Vary` mode is SPACE, the location will be drawn randomly.
+    If the `vampireman.data_structures.Vary` mode is SPACE, the location will be drawn randomly with
+    `generate_heatpump_locations()` from the cells that are not in `occupied_cells`.
+    If no `occupied_cells` are given, only the cells of the heat pumps with a fixed location are avoided, see
+    `fixed_heatpump_cells()`.
+    The random values are drawn from `rng`, or the `State` RNG if it is not given.
     """
 
+    if rng is None:
+        rng = state.get_rng()
+
     hp = deepcopy(parameter.value)
     assert isinstance(hp, HeatPump)
 
-    hp = handle_heatpump_values(state.get_rng(), hp)
+    hp = handle_heatpump_values(rng, hp)
 
     result_location = np.array(hp.location)
     if parameter.vary == Vary.SPACE:
-        result_location = generate_heatpump_location(state)  # XXX: Is this handling location clashes correctly?
+        if occupied_cells is None:
+            occupied_cells = fixed_heatpump_cells(state)
+        result_location = generate_heatpump_locations(state, 1, occupied_cells, rng)[0]
         resolution = state.general.cell_resolution
         # This is needed as we need to calculate the heatpump coordinates for pflotran.in
         result_location = (np.array(result_location) - 1) * resolution + (resolution * 0.5)
@@ -59,11 +108,19 @@ def vary_heatpump(state: State, parameter: Parameter) -> Data:
     )
 
 
-def vary_parameter(state: State, parameter: Parameter, index: int) -> Data:
+def vary_parameter(
+    state: State,
+    parameter: Parameter,
+    index: int,
+    occupied_cells: None | set[int] = None,
+    rng: None | np.random.Generator = None,
+) -> Data:
     """
     This function does the variation of `vampireman.data_structures.Parameter`s.
     It does so by implementing a large match-case that in turn invokes other functions that then work on the
     `vampireman.data_structures.Parameter.value` based on the `vampireman.data_structures.Parameter.vary` type.
+    The `occupied_cells` are passed on to `vary_heatpump()`.
+    The random values are drawn from `rng`, or the `State` RNG if it is not given.
     """
 
     assert not isinstance(parameter.value, HeatPumps)
@@ -104,7 +161,12 @@ def vary_parameter(state: State, parameter: Parameter, index: int) -> Data:
             if isinstance(parameter.value, ValuePerlin):
                 data = Data(
                     name=parameter.name,
-                    value=create_perlin_field(state, parameter),
+                    value=create_perlin_field(state, parameter, rng),
+                )
+            elif isinstance(parameter.value, ValueGaussianField):
+                data = Data(
+                    name=parameter.name,
+                    value=create_gaussian_field(state, parameter, rng),
                 )
             elif isinstance(parameter.value, float):
                 raise ValueError(
@@ -113,7 +175,7 @@ def vary_parameter(state: State, parameter: Parameter, index: int) -> Data:
                 )
             # This should be inside the CONST block, yet it seems to make more sense to users to find it here
             elif isinstance(parameter.value, HeatPump):
-                data = vary_heatpump(state, parameter)
+                data = vary_heatpump(state, parameter, occupied_cells, rng)
             elif isinstance(parameter.value, ValueMinMax):
                 raise ValueError(
                     f"Parameter {parameter.name} is vary.space and has min/max values, "
@@ -151,62 +213,373 @@ def handle_heatpump_values(rand: np.random.Generator, hp_data: HeatPump) -> Heat
     return hp_data
 
 
-def generate_heatpump_location(state: State) -> list[float]:
+def generate_heatpump_locations(
+    state: State, number: int, occupied_cells: set[int], rng: None | np.random.Generator = None
+) -> list[list[float]]:
+    """
+    Return `number` distinct random heat pump locations, cell based, that are not in the `occupied_cells`.
+    The cells are drawn from the flattened cell ids of the domain, see `cell_id()`, and are added to the
+    `occupied_cells`.
+    While at least half of the domain stays free, cells are drawn one by one and redrawn if they are taken already,
+    which takes less than two draws per location on average, independently of the number of `occupied_cells`.
+    Otherwise, they are drawn without replacement from the free cells.
+    The random values are drawn from `rng`, or the `State` RNG if it is not given.
+    """
+
+    if rng is None:
+        rng = state.get_rng()
+
+    number_cells = cast(np.ndarray, state.general.number_cells)
+    total_cells = int(np.prod(number_cells))
+    if number > total_cells - len(occupied_cells):
+        raise ValueError(
+            f"Can not place {number} heat pumps, only {total_cells - len(occupied_cells)} cells of the domain are free"
+        )
+
+    if 2 * (len(occupied_cells) + number) <= total_cells:
+        cell_ids = []
+        while len(cell_ids) < number:
+            for cell in rng.integers(total_cells, size=number - len(cell_ids)).tolist():
+                if cell not in occupied_cells:
+                    occupied_cells.add(cell)
+                    cell_ids.append(cell)
+    else:
+        free_cells = np.setdiff1d(np.arange(total_cells), np.fromiter(occupied_cells, int, len(occupied_cells)))
+        cell_ids = rng.choice(free_cells, size=number, replace=False).tolist()
+        occupied_cells.update(cell_ids)
+
+    locations = np.stack(np.unravel_index(cell_ids, number_cells), axis=-1) + 1
+    return cast(list[list[float]], locations.astype(float).tolist())
+
+
+def cell_id(state: State, cell: NDArray) -> None | int:
+    """
+    Return the flattened id of a `cell`, given as zero based indices per axis, or `None` if it is outside of the domain.
+    """
+
+    number_cells = cast(np.ndarray, state.general.number_cells)
+    if np.any(cell < 0) or np.any(cell >= number_cells):
+        return None
+    return int(np.ravel_multi_index(tuple(int(index) for index in cell), number_cells))
+
+
+def fixed_heatpump_cells(state: State) -> set[int]:
     """
-    Return a list of three random float values, cell based.
+    Return the ids of the cells that contain a `vampireman.data_structures.HeatPump` which is not varied spatially.
+    This expects the locations to be coordinates already, see
+    `vampireman.preparation_stage.preparation_stage.calculate_hp_coordinates`.
     """
 
-    random_vector = state.get_rng().random(3)
-    random_location = random_vector * cast(np.ndarray, state.general.number_cells)
-    return cast(list[float], np.ceil(random_location).tolist())
+    cells = set()
+    for parameter in state.heatpump_parameters.values():
+        if parameter.vary == Vary.SPACE or not isinstance(parameter.value, HeatPump):
+            continue
+        if parameter.value.location is None:
+            continue
+
+        cell = cell_id(state, np.floor(np.array(parameter.value.location) / state.general.cell_resolution))
+        if cell is not None:
+            cells.add(cell)
+
+    return cells
 
 
 def vary_params(state: State) -> State:
     """
-    Calls the `vary_parameter()` function for each `vampireman.data_structures.Parameter` in each
-    `vampireman.data_structures.Datapoint` sequentially.
+    Varies all `vampireman.data_structures.Parameter`s for all `vampireman.data_structures.Datapoint`s and adds them to
+    the `State`, see `generate_datapoints()`.
     """
 
-    for datapoint_index in range(state.general.number_datapoints):
-        data = {}
+    state.datapoints.extend(generate_datapoints(state))
+    return state
 
-        # This syntax merges the hydrogeological_parameters and the heatpump_parameters dicts so we don't have to write
-        # two separate for loops
-        for _, parameter in (state.hydrogeological_parameters | state.heatpump_parameters).items():
-            parameter_data = vary_parameter(state, parameter, datapoint_index)
-            data[parameter.name] = parameter_data
 
-        state.datapoints.append(DataPoint(index=datapoint_index, data=data))
+def generate_datapoints(state: State, defer_fields: bool = False) -> Iterator[DataPoint]:
+    """
+    Varies all `vampireman.data_structures.Parameter`s and yields the `vampireman.data_structures.Datapoint`s one after
+    the other.
+
+    Scalar parameters that are `vampireman.data_structures.Vary.FIXED` or `vampireman.data_structures.Vary.CONST` don't
+    need random numbers, so their values for all data points are computed at once as a column, see
+    `vary_scalar_parameter()`, or, depending on `vampireman.data_structures.GeneralConfig.const_sampling`,
+    `sample_const_parameters()`.
+    All other parameters are varied with `vary_datapoint()` for one data point after the other, or, with more than one
+    `vampireman.data_structures.GeneralConfig.number_workers`, with perlin fields computed in worker processes, see
+    `vary_params_in_parallel()`.
+    The `vampireman.data_structures.DataPoint`s are only created at the end, after shuffling the columns.
+
+    With `defer_fields`, only the random values of the spatially varied fields are drawn up front, and each field is
+    computed when its data point is yielded, see `draw_field()`.
+    So only the fields of one data point are held in memory at a time, and the data points are the same as without it.
+    """
+
+    # This syntax merges the hydrogeological_parameters and the heatpump_parameters dicts so we don't have to write two
+    # separate for loops
+    parameters = list((state.hydrogeological_parameters | state.heatpump_parameters).values())
+    number_datapoints = state.general.number_datapoints
+
+    design_columns = sample_const_parameters(state, parameters)
+    scalar_columns = {
+        parameter.name: design_columns[parameter.name]
+        if parameter.name in design_columns
+        else vary_scalar_parameter(state, parameter)
+        for parameter in parameters
+    }
+
+    other_parameters = [parameter for parameter in parameters if scalar_columns[parameter.name] is None]
+    rows: list[dict[str, Data | DeferredField]]
+    if state.general.number_workers > 1 and not defer_fields:
+        rows = cast(list[dict[str, Data | DeferredField]], vary_params_in_parallel(state, other_parameters))
+    else:
+        fixed_cells = fixed_heatpump_cells(state)
+        rows = [
+            vary_datapoint(state, other_parameters, datapoint_index, fixed_cells, defer_fields)
+            for datapoint_index in range(number_datapoints)
+        ]
+
+    # Keep the order of the parameters, it determines the order of the random numbers drawn for shuffling
+    columns: dict[str, NDArray | list[Data | DeferredField]] = {}
+    for parameter in parameters:
+        scalar_column = scalar_columns[parameter.name]
+        if scalar_column is None:
+            columns[parameter.name] = [row[parameter.name] for row in rows]
+        else:
+            columns[parameter.name] = scalar_column
+    del rows
 
     if state.general.shuffle_datapoints:
-        state = shuffle_datapoints(state)
+        shuffle_columns(state, columns, design_columns.keys())
         logging.debug("Shuffled datapoints")
 
-    return state
+    # Convert the scalar columns to lists of Python floats all at once
+    values = {name: column if isinstance(column, list) else column.tolist() for name, column in columns.items()}
+    for datapoint_index in range(number_datapoints):
+        data = {}
+        for name, column in values.items():
+            value = column[datapoint_index]
+            if isinstance(value, Data):
+                data[name] = value
+            elif callable(value):
+                data[name] = Data(name=name, value=value())
+            else:
+                data[name] = Data(name=name, value=value)
+
+        yield DataPoint(index=datapoint_index, data=data)
 
 
-def shuffle_datapoints(state: State) -> State:
+def vary_datapoint(
+    state: State, parameters: list[Parameter], datapoint_index: int, fixed_cells: set[int], defer_fields: bool = False
+) -> dict[str, Data | DeferredField]:
     """
-    Shuffles all `vampireman.data_structures.Parameter`s randomly in between the different
-    `vampireman.data_structures.DataPoint`s.
-    This is needed when e.g. two parameters are generated as `vampireman.data_structures.Vary.CONST` with
-    `vampireman.data_structures.ValueMinMax`, as otherwise they would both have min values in the first
-    `vampireman.data_structures.DataPoint` and max values in the last one.
+    Varies the `parameters` for one `vampireman.data_structures.DataPoint`, one after the other.
+    Spatially varied heat pumps are placed in distinct cells, avoiding the `fixed_cells` (see `fixed_heatpump_cells()`).
+    With `defer_fields`, spatially varied fields are not computed yet, see `draw_field()`.
+
+    With `vampireman.data_structures.GeneralConfig.datapoint_random_streams`, all random values are drawn from the
+    stream of the data point, so the result doesn't depend on which other data points were varied before.
     """
 
-    parameters: dict[str, list[Data]] = {}
+    rng = state.get_rng(datapoint_index)
+    occupied_cells = set(fixed_cells)
 
-    parameter_names = list(state.datapoints[0].data)
-    for parameter in parameter_names:
-        for datapoint in state.datapoints:
-            param_list = parameters.get(parameter, [])
-            param_list.append(datapoint.data[parameter])
-            parameters[parameter] = param_list
+    data: dict[str, Data | DeferredField] = {}
+    for parameter in parameters:
+        field = draw_field(state, parameter, rng) if defer_fields else None
+        if field is None:
+            data[parameter.name] = vary_parameter(state, parameter, datapoint_index, occupied_cells, rng)
+        else:
+            data[parameter.name] = field
 
-        state.get_rng().shuffle(cast(ArrayLike, parameters[parameter]))
+    return data
 
-    for parameter in parameter_names:
-        for index in range(state.general.number_datapoints):
-            state.datapoints[index].data[parameter] = parameters[parameter][index]
 
-    return state
+def draw_field(state: State, parameter: Parameter, rng: np.random.Generator) -> None | DeferredField:
+    """
+    Draws the random values of a spatially varied perlin or Gaussian random field from `rng`, the same way
+    `vary_parameter()` does, and returns a function that computes the field from them later.
+    Returns `None` for all other parameters.
+    """
+
+    if parameter.vary != Vary.SPACE:
+        return None
+
+    if isinstance(parameter.value, ValuePerlin):
+        base_offset, freq_factor = draw_perlin_offset_and_frequency(state, parameter, rng)
+        return partial(load_or_compute_perlin_field, state, parameter, base_offset, freq_factor)
+
+    if isinstance(parameter.value, ValueGaussianField):
+        return partial(compute_gaussian_field, state, parameter, draw_gaussian_seed(rng))
+
+    return None
+
+
+def vary_scalar_parameter(state: State, parameter: Parameter) -> None | NDArray:
+    """
+    Calculate the values of a scalar `vampireman.data_structures.Parameter` for all data points at once.
+    This gives the same values as `vary_parameter()` for each data point.
+    Returns `None` if the parameter is not a `vampireman.data_structures.Vary.FIXED` float or a
+    `vampireman.data_structures.Vary.CONST` `vampireman.data_structures.ValueMinMax`.
+    """
+
+    number_datapoints = state.general.number_datapoints
+
+    if parameter.vary == Vary.FIXED and isinstance(parameter.value, float):
+        return np.full(number_datapoints, parameter.value)
+
+    if parameter.vary == Vary.CONST and isinstance(parameter.value, ValueMinMax):
+        max = parameter.value.max
+        min = parameter.value.min
+
+        if parameter.distribution == Distribution.LOG:
+            max = np.log10(max)
+            min = np.log10(min)
+
+        distance = max - min
+        step_width = distance / (number_datapoints - 1)
+        values = min + step_width * np.arange(number_datapoints)
+
+        if parameter.distribution == Distribution.LOG:
+            # Not np.power, as its vectorized implementation can differ from the scalar one in the last digit
+            values = np.array([10**value for value in values.tolist()])
+
+        return values
+
+    return None
+
+
+def sample_const_parameters(state: State, parameters: list[Parameter]) -> dict[str, NDArray]:
+    """
+    Draws the values of all `vampireman.data_structures.Vary.CONST` parameters with
+    `vampireman.data_structures.ValueMinMax` values jointly from the quasi-random design selected by
+    `vampireman.data_structures.GeneralConfig.const_sampling`, seeded from the `State` RNG.
+    Each parameter is one dimension of the design, scaled to its min and max value, logarithmically for
+    `vampireman.data_structures.Distribution.LOG`.
+    Returns the column of values of each parameter, or nothing with `vampireman.data_structures.Sampling.GRID`.
+    """
+
+    const_parameters = [
+        parameter
+        for parameter in parameters
+        if parameter.vary == Vary.CONST and isinstance(parameter.value, ValueMinMax)
+    ]
+    sampling = state.general.const_sampling
+    if sampling == Sampling.GRID or len(const_parameters) == 0:
+        return {}
+
+    number_datapoints = state.general.number_datapoints
+    match sampling:
+        case Sampling.SOBOL:
+            engine = qmc.Sobol(len(const_parameters), scramble=True, seed=state.get_rng())
+            if number_datapoints & (number_datapoints - 1) != 0:
+                logging.warning(
+                    "The number of datapoints %s is not a power of two, so the Sobol' points are not fully balanced",
+                    number_datapoints,
+                )
+        case Sampling.LATIN_HYPERCUBE:
+            engine = qmc.LatinHypercube(len(const_parameters), scramble=True, seed=state.get_rng())
+
+    with warnings.catch_warnings():
+        # Already logged above
+        warnings.filterwarnings("ignore", message="The balance properties of Sobol' points")
+        design = engine.random(number_datapoints)
+
+    columns = {}
+    for parameter, samples in zip(const_parameters, design.T, strict=True):
+        value = cast(ValueMinMax, parameter.value)
+        if parameter.distribution == Distribution.LOG:
+            minimum, maximum = np.log10(value.min), np.log10(value.max)
+            columns[parameter.name] = np.power(10, minimum + samples * (maximum - minimum))
+        else:
+            columns[parameter.name] = value.min + samples * (value.max - value.min)
+
+    return columns
+
+
+def vary_params_in_parallel(state: State, parameters: list[Parameter]) -> list[dict[str, Data]]:
+    """
+    Does the same as calling `vary_parameter()` for the `parameters` for each data point, but computes the perlin fields
+    in a pool of worker processes.
+    The random offsets and frequencies of each field are still drawn from the `State` RNG in the main process, in the
+    same order as in a sequential run, so the resulting `vampireman.data_structures.Data` are identical.
+    Cached perlin fields are loaded in the main process, only the missing ones are computed by the workers.
+    """
+
+    # The workers only need the general config, don't send them the datapoints that were already generated
+    worker_state = State(general=state.general)
+    fixed_cells = fixed_heatpump_cells(state)
+
+    with ProcessPoolExecutor(max_workers=state.general.number_workers) as executor:
+        rows: list[dict[str, Data | Future]] = []
+        cache_keys: dict[Future, None | str] = {}
+        for datapoint_index in range(state.general.number_datapoints):
+            data: dict[str, Data | Future] = {}
+            rng = state.get_rng(datapoint_index)
+            occupied_cells = set(fixed_cells)
+
+            for parameter in parameters:
+                if parameter.vary == Vary.SPACE and isinstance(parameter.value, ValuePerlin):
+                    base_offset, freq_factor = draw_perlin_offset_and_frequency(state, parameter, rng)
+
+                    cache_key = None
+                    cells = None
+                    if state.general.perlin_cache_directory is not None:
+                        cache_key = perlin_field_cache_key(state, parameter, base_offset, freq_factor)
+                        cells = load_perlin_field(state, cache_key)
+
+                    if cells is None:
+                        future = executor.submit(
+                            compute_perlin_field, worker_state, parameter, base_offset, freq_factor
+                        )
+                        cache_keys[future] = cache_key
+                        data[parameter.name] = future
+                    else:
+                        data[parameter.name] = Data(name=parameter.name, value=cells)
+                else:
+                    data[parameter.name] = vary_parameter(state, parameter, datapoint_index, occupied_cells, rng)
+
+            rows.append(data)
+
+        for data in rows:
+            for name, parameter_data in data.items():
+                if isinstance(parameter_data, Future):
+                    cells = parameter_data.result()
+                    cache_key = cache_keys[parameter_data]
+                    if cache_key is not None:
+                        store_perlin_field(state, cache_key, cells)
+                    data[name] = Data(name=name, value=cells)
+
+    return cast(list[dict[str, Data]], rows)
+
+
+def shuffle_columns(
+    state: State, columns: dict[str, NDArray | list[Data | DeferredField]], joint_columns: Collection[str] = ()
+):
+    """
+    Shuffles the values of each `vampireman.data_structures.Parameter` randomly in between the different
+    `vampireman.data_structures.DataPoint`s, using one permutation per parameter.
+    This is needed when e.g. two parameters are generated as `vampireman.data_structures.Vary.CONST` with
+    `vampireman.data_structures.ValueMinMax`, as otherwise they would both have min values in the first
+    `vampireman.data_structures.DataPoint` and max values in the last one.
+
+    The `vampireman.data_structures.HeatPump`s of a data point were placed in distinct cells, so they are all shuffled
+    with the same permutation to keep them together.
+    The same goes for the `joint_columns`, e.g., the columns of a quasi-random design, see `sample_const_parameters()`.
+    """
+
+    heatpump_permutation = None
+    joint_permutation = None
+    for name, column in columns.items():
+        permutation = state.get_rng().permutation(len(column))
+        if name in joint_columns:
+            if joint_permutation is None:
+                joint_permutation = permutation
+            # The joint columns are always arrays of a design
+            columns[name] = cast(NDArray, column)[joint_permutation]
+        elif isinstance(column, list):
+            if len(column) > 0 and isinstance(column[0], Data) and isinstance(column[0].value, HeatPump):
+                if heatpump_permutation is None:
+                    heatpump_permutation = permutation
+                permutation = heatpump_permutation
+            columns[name] = [column[index] for index in permutation]
+        else:
+            columns[name] = column[permutation]
@@ -0,0 +1,101 @@
+import math
+from typing import Any, cast
+
+import numpy as np
+import scipy.fft
+from numpy.typing import NDArray
+
+from ..data_structures import Distribution, Parameter, State, ValueGaussianField
+
+
+def create_gaussian_field(
+    state: State, parameter: Parameter, rng: None | np.random.Generator = None
+) -> NDArray[np.floating[Any]]:
+    """
+    Creates a Gaussian random field for a data point from a `vampireman.data_structures.Parameter` with a
+    `vampireman.data_structures.ValueGaussianField` value.
+    The random values are drawn from `rng`, or the `State` RNG if it is not given.
+    """
+
+    if rng is None:
+        rng = state.get_rng()
+
+    return compute_gaussian_field(state, parameter, draw_gaussian_seed(rng))
+
+
+def draw_gaussian_seed(rng: np.random.Generator) -> int:
+    """
+    Draw the seed for the white noise of a Gaussian random field, see `compute_gaussian_field()`.
+    Only a seed is drawn from the `rng`, so the number of random values drawn from it does not depend on the grid.
+    """
+
+    return int(rng.integers(2**63))
+
+
+def compute_gaussian_field(state: State, parameter: Parameter, seed: int) -> NDArray[np.floating[Any]]:
+    """
+    Compute the Gaussian random field of a `vampireman.data_structures.Parameter` by spectral synthesis: white noise
+    drawn with `seed` is filtered with the square root of the spectral density of the Gaussian covariance in Fourier
+    space.
+    This needs O(N log N) operations for N cells.
+
+    The FFT yields a periodic field, so the noise is generated on a grid that is padded by up to three correlation
+    lengths (but at most the size of the domain) in each direction, and only the part covering the domain is kept.
+    The field has the `vampireman.data_structures.GeneralConfig.precision`.
+    """
+
+    value = parameter.value
+    assert isinstance(value, ValueGaussianField)
+
+    if parameter.name == "pressure_gradient":
+        raise ValueError(f"Parameter {parameter.name} can not be a Gaussian random field, use a perlin field instead")
+    if parameter.distribution == Distribution.LOG and value.mean <= 0:
+        raise ValueError(f"Parameter {parameter.name} is logarithmic, so its mean must be positive; {parameter}")
+
+    number_cells = [int(n) for n in cast(np.ndarray, state.general.number_cells)]
+    resolution = state.general.cell_resolution
+    dtype = np.dtype(state.general.precision)
+
+    padded_cells = [
+        cast(int, scipy.fft.next_fast_len(n + min(n, math.ceil(3 * length / resolution)), real=True))
+        for n, length in zip(number_cells, value.correlation_length, strict=True)
+    ]
+
+    noise = np.random.default_rng(seed).standard_normal(tuple(padded_cells), dtype=dtype)
+    spectrum = scipy.fft.rfftn(noise, overwrite_x=True, workers=state.general.number_workers)
+    del noise
+
+    # The spectral density of the Gaussian covariance factorizes into one term per axis, so the filter is applied axis
+    # by axis, which avoids building it for the whole grid
+    for axis, (n, length) in enumerate(zip(padded_cells, value.correlation_length, strict=True)):
+        wave_numbers = 2 * np.pi * scipy.fft.fftfreq(n, d=resolution)
+        density = np.exp(-((wave_numbers * length) ** 2) / 4)
+        if axis == len(padded_cells) - 1:
+            # The last axis of the real FFT only holds the non-negative frequencies
+            density_half = np.exp(-((2 * np.pi * scipy.fft.rfftfreq(n, d=resolution) * length) ** 2) / 4)
+        else:
+            density_half = density
+
+        # Normalized over all frequencies, so the filtered noise has unit variance
+        axis_filter = np.sqrt(density_half / density.mean()).astype(dtype)
+        shape = [1] * len(padded_cells)
+        shape[axis] = -1
+        spectrum *= axis_filter.reshape(shape)
+
+    field = cast(
+        np.ndarray, scipy.fft.irfftn(spectrum, s=padded_cells, overwrite_x=True, workers=state.general.number_workers)
+    )
+    del spectrum
+
+    # Copy the domain out of the padded grid, so the padding can be freed
+    cells = np.array(field[tuple(slice(n) for n in number_cells)])
+    del field
+
+    cells *= math.sqrt(value.variance)
+    if parameter.distribution == Distribution.LOG:
+        cells += math.log10(value.mean)
+        cells = np.power(10, cells, out=cells)
+    else:
+        cells += value.mean
+
+    return cells
@@ -1,10 +1,94 @@
+import tempfile
 from typing import Any, cast
 
-import noise
 import numpy as np
 from numpy.typing import NDArray
 
 from ..data_structures import Distribution, Parameter, State, ValueMinMax, ValuePerlin
+from .perlin_cache import load_perlin_field, perlin_field_cache_key, store_perlin_field
+
+# Permutation table and gradient set of Ken Perlin's improved noise, as used by `noise.pnoise3`
+PERMUTATION = np.array(
+    [
+        151, 160, 137, 91, 90, 15, 131, 13, 201, 95, 96, 53, 194, 233, 7, 225, 140, 36, 103, 30, 69, 142, 8, 99, 37,
+        240, 21, 10, 23, 190, 6, 148, 247, 120, 234, 75, 0, 26, 197, 62, 94, 252, 219, 203, 117, 35, 11, 32, 57,
+        177, 33, 88, 237, 149, 56, 87, 174, 20, 125, 136, 171, 168, 68, 175, 74, 165, 71, 134, 139, 48, 27, 166, 77,
+        146, 158, 231, 83, 111, 229, 122, 60, 211, 133, 230, 220, 105, 92, 41, 55, 46, 245, 40, 244, 102, 143, 54,
+        65, 25, 63, 161, 1, 216, 80, 73, 209, 76, 132, 187, 208, 89, 18, 169, 200, 196, 135, 130, 116, 188, 159, 86,
+        164, 100, 109, 198, 173, 186, 3, 64, 52, 217, 226, 250, 124, 123, 5, 202, 38, 147, 118, 126, 255, 82, 85,
+        212, 207, 206, 59, 227, 47, 16, 58, 17, 182, 189, 28, 42, 223, 183, 170, 213, 119, 248, 152, 2, 44, 154,
+        163, 70, 221, 153, 101, 155, 167, 43, 172, 9, 129, 22, 39, 253, 19, 98, 108, 110, 79, 113, 224, 232, 178,
+        185, 112, 104, 218, 246, 97, 228, 251, 34, 242, 193, 238, 210, 144, 12, 191, 179, 162, 241, 81, 51, 145,
+        235, 249, 14, 239, 107, 49, 192, 214, 31, 181, 199, 106, 157, 184, 84, 204, 176, 115, 121, 50, 45, 127, 4,
+        150, 254, 138, 236, 205, 93, 222, 114, 67, 29, 24, 72, 243, 141, 128, 195, 78, 66, 215, 61, 156, 180,
+    ]
+    * 2,
+    dtype=np.intp,
+)  # fmt: skip
+GRADIENTS = np.array(
+    [
+        [1, 1, 0], [-1, 1, 0], [1, -1, 0], [-1, -1, 0],
+        [1, 0, 1], [-1, 0, 1], [1, 0, -1], [-1, 0, -1],
+        [0, 1, 1], [0, -1, 1], [0, 1, -1], [0, -1, -1],
+        [1, 0, -1], [-1, 0, -1], [0, -1, 1], [0, 1, 1],
+    ],
+    dtype=np.float32,
+).T.copy()  # fmt: skip
+# Gradient components per hash value, so the last permutation lookup and the gradient lookup become one
+CORNER_GRADIENTS = GRADIENTS[:, PERMUTATION & 15]
+PERLIN_REPEAT = np.float32(1024)
+
+
+def pnoise3(
+    x: NDArray[np.floating[Any]], y: NDArray[np.floating[Any]], z: NDArray[np.floating[Any]]
+) -> NDArray[np.float32]:
+    """
+    Evaluate three dimensional perlin noise for whole arrays of coordinates at once.
+    This reproduces `noise.pnoise3` with its default arguments: the computation is done in single precision with the
+    same operations in the same order, so the results are identical to calling `noise.pnoise3` for every point.
+    The coordinates are broadcast against each other, so for a grid it is sufficient to pass one axis per coordinate,
+    e.g. shapes `(nx, 1, 1)`, `(1, ny, 1)` and `(1, 1, nz)`.
+    """
+
+    x, y, z = (np.asarray(coordinate, dtype=np.float32) for coordinate in (x, y, z))
+
+    # Integer lattice coordinates of the unit cube containing the point and of its far corner
+    i, j, k = (np.floor(np.fmod(coordinate, PERLIN_REPEAT)).astype(np.intp) for coordinate in (x, y, z))
+    ii, jj, kk = (np.fmod((index + 1).astype(np.float32), PERLIN_REPEAT).astype(np.intp) for index in (i, j, k))
+    i, j, k, ii, jj, kk = (index & 255 for index in (i, j, k, ii, jj, kk))
+
+    # Relative position inside the cube and the fade curves
+    x, y, z = (coordinate - np.floor(coordinate) for coordinate in (x, y, z))
+    fx, fy, fz = (t * t * t * (t * (t * 6 - 15) + 10) for t in (x, y, z))
+
+    # Hash the corners of the cube
+    a = PERMUTATION[i]
+    aa = PERMUTATION[a + j]
+    ab = PERMUTATION[a + jj]
+    b = PERMUTATION[ii]
+    ba = PERMUTATION[b + j]
+    bb = PERMUTATION[b + jj]
+
+    def gradient(corner_hash, x, y, z):
+        gradient_x, gradient_y, gradient_z = (np.take(component, corner_hash) for component in CORNER_GRADIENTS)
+        return x * gradient_x + y * gradient_y + z * gradient_z
+
+    def lerp(t, a, b):
+        return a + t * (b - a)
+
+    return lerp(
+        fz,
+        lerp(
+            fy,
+            lerp(fx, gradient(aa + k, x, y, z), gradient(ba + k, x - 1, y, z)),
+            lerp(fx, gradient(ab + k, x, y - 1, z), gradient(bb + k, x - 1, y - 1, z)),
+        ),
+        lerp(
+            fy,
+            lerp(fx, gradient(aa + kk, x, y, z - 1), gradient(ba + kk, x - 1, y, z - 1)),
+            lerp(fx, gradient(ab + kk, x, y - 1, z - 1), gradient(bb + kk, x - 1, y - 1, z - 1)),
+        ),
+    )
 
 
 def make_perlin_grid(
@@ -16,7 +100,8 @@ def make_perlin_grid(
 ) -> NDArray[np.floating[Any]]:
     """
     Generate a perlin grid in the size of the domain as a numpy array.
-    Values are calculated between the `aimed_min` and `aimed_max`.
+    Values are calculated between the `aimed_min` and `aimed_max`, in the
+    `vampireman.data_structures.GeneralConfig.precision`.
     """
 
     grid_dimensions: list[int] = state.general.number_cells.tolist()  # pyright: ignore
@@ -34,36 +119,92 @@ def make_perlin_grid(
     simulation_area_max = max(grid_dimensions)
     scale = np.array(grid_dimensions) / simulation_area_max
 
-    # Create the grid indices
-    i, j, k = np.meshgrid(
-        np.arange(grid_dimensions[0]), np.arange(grid_dimensions[1]), np.arange(grid_dimensions[2]), indexing="ij"
-    )
+    # Create the grid indices, one axis per dimension so they broadcast to the full grid
+    i, j, k = np.ix_(np.arange(grid_dimensions[0]), np.arange(grid_dimensions[1]), np.arange(grid_dimensions[2]))
 
     # Normalize
     x = (i / grid_dimensions[0] * scale[0] + offset[0]) * freq[0]
     y = (j / grid_dimensions[1] * scale[1] + offset[1]) * freq[1]
     z = (k / grid_dimensions[2] * scale[2] + offset[2]) * freq[2]
 
-    values = np.vectorize(noise.pnoise3)(x, y, z)
+    dtype = np.dtype(state.general.precision)
+    chunk_size = state.general.perlin_chunk_size
+    if chunk_size is None:
+        values = np.empty(grid_dimensions, dtype=dtype)
+        chunks = [slice(None)]
+    else:
+        # The temporary file is deleted right away, its space is freed once the array is no longer used
+        with tempfile.TemporaryFile() as file:
+            values = np.memmap(file, dtype=dtype, mode="w+", shape=tuple(grid_dimensions))
+        rows_per_chunk = max(1, chunk_size // (grid_dimensions[1] * grid_dimensions[2]))
+        chunks = [slice(row, row + rows_per_chunk) for row in range(0, grid_dimensions[0], rows_per_chunk)]
+
+    current_min = np.inf
+    current_max = -np.inf
+    for chunk in chunks:
+        values[chunk] = pnoise3(x[chunk], y, z)
+        current_min = min(current_min, np.min(values[chunk]))
+        current_max = max(current_max, np.max(values[chunk]))
 
     # scale to intended range
-    current_min = np.min(values)
-    current_max = np.max(values)
-
-    values = (values - current_min) / (current_max - current_min)
-    values = values * (aimed_max - aimed_min) + aimed_min
+    for chunk in chunks:
+        scaled = (values[chunk] - current_min) / (current_max - current_min)
+        values[chunk] = scaled * (aimed_max - aimed_min) + aimed_min
 
     return values
 
 
-def create_perlin_field(state: State, parameter: Parameter):
+def create_perlin_field(
+    state: State, parameter: Parameter, rng: None | np.random.Generator = None
+) -> NDArray[np.floating[Any]]:
     """
     Creates a perlin field for a data point from a `vampireman.data_structures.Parameter`.
     If the `vampireman.data_structures.ValuePerlin.frequency` is a `vampireman.data_structures.ValueMinMax`, random
     values will be calculated.
+    When `vampireman.data_structures.GeneralConfig.perlin_cache_directory` is set, the field is loaded from the cache
+    if it was computed before, see `vampireman.variation_stage.perlin_cache`.
+    The random values are drawn from `rng`, or the `State` RNG if it is not given.
+    """
+
+    base_offset, freq_factor = draw_perlin_offset_and_frequency(state, parameter, rng)
+    return load_or_compute_perlin_field(state, parameter, base_offset, freq_factor)
+
+
+def load_or_compute_perlin_field(
+    state: State, parameter: Parameter, base_offset: NDArray[np.floating[Any]], freq_factor: list[float]
+) -> NDArray[np.floating[Any]]:
+    """
+    Computes the perlin field with `compute_perlin_field()`, or loads it from the cache if
+    `vampireman.data_structures.GeneralConfig.perlin_cache_directory` is set and it was computed before.
+    """
+
+    if state.general.perlin_cache_directory is None:
+        return compute_perlin_field(state, parameter, base_offset, freq_factor)
+
+    key = perlin_field_cache_key(state, parameter, base_offset, freq_factor)
+    cells = load_perlin_field(state, key)
+    if cells is None:
+        cells = compute_perlin_field(state, parameter, base_offset, freq_factor)
+        store_perlin_field(state, key, cells)
+
+    return cells
+
+
+def draw_perlin_offset_and_frequency(
+    state: State, parameter: Parameter, rng: None | np.random.Generator = None
+) -> tuple[NDArray[np.floating[Any]], list[float]]:
     """
+    Draw the random offset and, if the `vampireman.data_structures.ValuePerlin.frequency` is a
+    `vampireman.data_structures.ValueMinMax`, the frequencies of a perlin field from `rng`, or the `State` RNG if it is
+    not given.
+    This is all the randomness that goes into a perlin field, so the field itself can be computed anywhere afterwards
+    with `compute_perlin_field()`.
+    """
+
+    if rng is None:
+        rng = state.get_rng()
 
-    base_offset = state.get_rng().random(3) * 4242
+    base_offset = rng.random(3) * 4242
 
     if not isinstance(parameter.value, ValuePerlin):
         raise ValueError()
@@ -72,7 +213,7 @@ def create_perlin_field(state: State, parameter: Parameter):
 
     if isinstance(freq_factor, ValueMinMax):
         # If the frequency is `ValueMinMax`, get random values for x,y,z
-        rand = state.get_rng()
+        rand = rng
 
         min = freq_factor.min
         max = freq_factor.max
@@ -86,6 +227,19 @@ def create_perlin_field(state: State, parameter: Parameter):
     if not isinstance(freq_factor, list):
         raise ValueError()
 
+    return base_offset, freq_factor
+
+
+def compute_perlin_field(
+    state: State, parameter: Parameter, base_offset: NDArray[np.floating[Any]], freq_factor: list[float]
+) -> NDArray[np.floating[Any]]:
+    """
+    Compute the perlin field of a `vampireman.data_structures.Parameter` for the given offset and frequencies.
+    This does not use the `State` RNG, so it can run in a worker process.
+    """
+
+    assert isinstance(parameter.value, ValuePerlin)
+
     vary_min = parameter.value.min
     vary_max = parameter.value.max
 
@@ -102,7 +256,7 @@ def create_perlin_field(state: State, parameter: Parameter):
     )
 
     if parameter.distribution == Distribution.LOG:
-        cells = 10**cells
+        cells = np.power(10, cells, out=cells)
 
     if parameter.name == "pressure_gradient":
         cells = calc_pressure_from_gradient_field(cells, state, parameter)
@@ -113,11 +267,17 @@ def create_perlin_field(state: State, parameter: Parameter):
 def create_const_field(state: State, value: float | NDArray):
     """
     Create a constant field, as large as the domain, with the same `value` for each cell.
+    The field has the `vampireman.data_structures.GeneralConfig.precision`.
+
+    If `value` already is a field, it is only reshaped to the domain.
+    This doesn't copy it if it already has the right precision, so a field that is shared by several data points stays
+    shared.
     """
 
     if np.size(value) > 1:
         value = value.reshape(state.general.number_cells)  # pyright: ignore
-    return np.full(cast(np.ndarray, state.general.number_cells), value)
+        return value.astype(np.dtype(state.general.precision), copy=False)  # pyright: ignore
+    return np.full(cast(np.ndarray, state.general.number_cells), value, dtype=np.dtype(state.general.precision))
 
 
 def calc_pressure_from_gradient_field(
@@ -125,6 +285,8 @@ def calc_pressure_from_gradient_field(
 ) -> NDArray[np.floating[Any]]:
     """
     This function calculates a pressure field from a gradient field.
+    The pressure is integrated along the second axis with a cumulative sum, working in place on the `gradient_field` if
+    it is in double precision already.
 
     WARNING: It is unclear if this function is implemented correctly.
     """
@@ -132,22 +294,32 @@ def calc_pressure_from_gradient_field(
     value = parameter.value
     assert isinstance(value, ValueMinMax | ValuePerlin)
 
+    # Always double precision, see `vampireman.data_structures.GeneralConfig.precision`
+    pressure_field = gradient_field.astype(np.float64, copy=False)
+
     # scale pressure field to min and max values from state
-    current_min = np.min(gradient_field)
-    current_max = np.max(gradient_field)
+    current_min = np.min(pressure_field)
+    current_max = np.max(pressure_field)
 
     new_min = value.min
     new_max = value.max
 
-    gradient_field = (gradient_field - current_min) / (current_max - current_min) * (new_max - new_min) + new_min
-
     reference = 101325  # Standard atmosphere pressure in Pa
     resolution = state.general.cell_resolution
 
-    pressure_field = np.zeros_like(gradient_field)
-    pressure_field[:, 0] = reference
-    for i in range(1, pressure_field.shape[1]):
-        pressure_field[:, i] = pressure_field[:, i - 1] + gradient_field[:, i] * resolution * 1000
+    # Work on one slab after the other, so all steps are done while the slab is in the cache
+    for slab in pressure_field:
+        slab -= current_min
+        slab /= current_max - current_min
+        slab *= new_max - new_min
+        slab += new_min
+
+        # Each cell adds its gradient to the pressure of the previous cell, starting from the reference pressure
+        slab *= resolution
+        slab *= 1000
+        slab[0] = reference
+        np.cumsum(slab, axis=0, out=slab)
+
     pressure_field = pressure_field[::-1]
 
     return pressure_field